@@ -1,58 +1,233 @@
-import json
+import hashlib
+import io
+import os
+import pickle
+import sys
 from pathlib import Path
-import click
-
-from .parser import parse as parse_text
-from .runtime import Engine
-
-@click.group(help="Agent DSL command-line tool.")
-def cli() -> None:
-    pass
-
-@cli.command("run", help="Run a DSL file from its first state.")
-@click.argument("script", type=click.Path(exists=True, dir_okay=False, path_type=Path))
-@click.option("--flow", default="main", show_default=True, help="Flow name to run")
-@click.option("--var", multiple=True, help="预置变量，形如 name=Alice，可重复传入多次")
-@click.option("--data", type=click.Path(dir_okay=False, path_type=Path),
-              help="上下文 JSON 文件；启动时加载，结束时保存")
-@click.option("--no-save", is_flag=True, help="与 --data 同用时，运行结束不回写上下文")
-@click.option("--llm", type=click.Choice(["none", "deepseek"]), default="none",
-              show_default=True, help="是否启用LLM意图识别")
-def run_cmd(script: Path, flow: str, var: tuple[str, ...], data: Path | None,
-            no_save: bool, llm: str) -> None:
-    text = script.read_text(encoding="utf-8")
-    prog = parse_text(text)
-
-    ctx: dict[str, str] = {}
-    for item in var:
-        if "=" not in item:
-            raise click.UsageError(f"--var 需要 name=value 形式，收到：{item}")
-        k, v = item.split("=", 1)
-        ctx[k] = v
+from typing import TYPE_CHECKING, Callable, Dict, Optional, Sequence
 
-    if data and data.exists():
+from .jsonio import dump_file, loads
+from .paths import cache_dir
+
+# parser / runtime 只在真正执行脚本时才导入，--help 等路径不承担其导入开销；
+# click 只在走完整命令行（帮助、报错、非 run 命令）时才导入，见 main()
+if TYPE_CHECKING:
+    from .parser import Program
+
+# 读脚本时的块/缓冲大小（默认 8 KiB 对大文件偏小）
+_READ_SIZE = 1 << 20
+# 解析缓存最多保留的文件数；超出时按最近使用时间淘汰
+_PARSE_CACHE_MAX = 64
+
+def _parser_fingerprint() -> bytes:
+    """解析结果（pickle）依赖的模块源码摘要：parser/expr/template 有改动时，
+    即使忘了改 PROGRAM_FORMAT，旧缓存也不会被误用。"""
+    h = hashlib.sha256()
+    pkg = Path(__file__).parent
+    for name in ("parser.py", "expr.py", "template.py"):
+        try:
+            h.update((pkg / name).read_bytes())
+        except OSError:   # 只有字节码等少见的安装方式：退化为只看 PROGRAM_FORMAT
+            h.update(name.encode("utf-8"))
+    return h.digest()
+
+def _prune_parse_cache(folder: Path) -> None:
+    """缓存文件超过上限时删掉最久没用过的（命中时会刷新 mtime）。"""
+    try:
+        entries = [(p.stat().st_mtime, p) for p in folder.glob("*.pkl")]
+        if len(entries) <= _PARSE_CACHE_MAX:
+            return
+        entries.sort()
+        for _, p in entries[:len(entries) - _PARSE_CACHE_MAX]:
+            p.unlink(missing_ok=True)
+    except OSError:
+        pass
+
+class _HashingReader(io.RawIOBase):
+    """读多少就把多少字节喂给摘要：解析与算键用的是同一份字节。"""
+    def __init__(self, raw, digest):
+        self._raw, self._digest = raw, digest
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = self._raw.readinto(b)
+        if n:
+            self._digest.update(memoryview(b)[:n])
+        return n
+
+def _load_program(script: Path) -> "Program":
+    """
+    解析脚本；以脚本内容（连同解析器版本）的 SHA-256 为键在用户缓存目录下缓存解析结果。
+    摘要按块计算、未命中时逐行流式解析，整个过程不把脚本全文读入内存。
+    未命中时按解析时实际读到的字节重新计算摘要再写缓存：两次打开之间文件被改，
+    新内容的解析结果也不会记在旧内容的键下。
+    """
+    from .parser import PROGRAM_FORMAT, Program, parse_stream
+
+    seed = hashlib.sha256(f"{PROGRAM_FORMAT}\0".encode("utf-8"))
+    seed.update(_parser_fingerprint())
+    digest = seed.copy()
+    # 无缓冲 + 1 MiB 块读：大脚本的摘要只需少量 read() 系统调用，且不多一次缓冲拷贝
+    with script.open("rb", buffering=0) as f:
+        for chunk in iter(lambda: f.read(_READ_SIZE), b""):
+            digest.update(chunk)
+    cache_path = cache_dir() / "parse" / f"{digest.hexdigest()}.pkl"
+    if cache_path.exists():
         try:
-            raw = json.loads(data.read_text(encoding="utf-8") or "{}")
-            if isinstance(raw, dict):
-                ctx.update({k: str(v) for k, v in raw.items()})
+            prog = pickle.loads(cache_path.read_bytes())
+            if isinstance(prog, Program):
+                os.utime(cache_path)   # 记录最近使用，供淘汰参考
+                return prog
         except Exception:
-            pass
+            pass  # 缓存损坏或不兼容：重新解析并覆盖
+    digest = seed.copy()
+    with script.open("rb", buffering=0) as raw:
+        f = io.TextIOWrapper(io.BufferedReader(_HashingReader(raw, digest), _READ_SIZE),
+                             encoding="utf-8")
+        prog = parse_stream(f)
+        f.read()   # 摘要要覆盖整个文件
+    cache_path = cache_path.with_name(f"{digest.hexdigest()}.pkl")
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_path.write_bytes(pickle.dumps(prog, protocol=pickle.HIGHEST_PROTOCOL))
+        _prune_parse_cache(cache_path.parent)
+    except OSError:
+        pass  # 缓存目录不可写时不影响运行
+    return prog
 
-    def ask_fn(k: str, prompt: str) -> str:
-        return click.prompt(prompt, type=str)
+def _run_script(script: Path, flow: str, ctx: Dict[str, str], data: Optional[Path],
+                no_save: bool, llm: str, ask_fn: Callable[[str, str], str],
+                echo: Callable[[str], None]) -> None:
+    """run 命令的主体；Click 与 argparse 两条入口共用。"""
+    from .runtime import Engine
+
+    prog = _load_program(script)
+
+    if data and data.exists():
+        try:
+            raw = loads(data.read_bytes() or b"{}")
+        except Exception:
+            raw = None
+        if isinstance(raw, dict):
+            ctx.update({k: str(v) for k, v in raw.items()})
+        else:
+            # 读不出 JSON 对象：不合并，结束时也不覆盖它，免得把用户数据写丢
+            print(f"[agent-dsl] ⚠ {data} 不是有效的 JSON 对象，本次运行不会写回该文件",
+                  file=sys.stderr)
+            no_save = True
 
     use_llm = (llm == "deepseek")
-    eng = Engine(prog, flow_name=flow, context=ctx, ask_fn=ask_fn, use_llm=use_llm)
+    eng = Engine(prog, flow_name=flow, context=ctx, ask_fn=ask_fn, use_llm=use_llm,
+                 own_context=True)
 
     for line in eng.run_iter():
-        click.echo(line)
+        echo(line)
 
     if data and not no_save:
         data.parent.mkdir(parents=True, exist_ok=True)
-        data.write_text(json.dumps(eng.ctx, ensure_ascii=False, indent=2), encoding="utf-8")
+        dump_file(data, eng.ctx)
+
+def _build_click_cli():
+    import click
+
+    @click.group(help="Agent DSL command-line tool.")
+    def cli() -> None:
+        pass
+
+    @cli.command("run", help="Run a DSL file from its first state.")
+    @click.argument("script", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+    @click.option("--flow", default="main", show_default=True, help="Flow name to run")
+    @click.option("--var", multiple=True, help="预置变量，形如 name=Alice，可重复传入多次")
+    @click.option("--data", type=click.Path(dir_okay=False, path_type=Path),
+                  help="上下文 JSON 文件；启动时加载，结束时保存")
+    @click.option("--no-save", is_flag=True, help="与 --data 同用时，运行结束不回写上下文")
+    @click.option("--llm", type=click.Choice(["none", "deepseek"]), default="none",
+                  show_default=True, help="是否启用LLM意图识别")
+    def run_cmd(script: Path, flow: str, var: tuple[str, ...], data: Path | None,
+                no_save: bool, llm: str) -> None:
+        ctx: dict[str, str] = {}
+        for item in var:
+            if "=" not in item:
+                raise click.UsageError(f"--var 需要 name=value 形式，收到：{item}")
+            k, v = item.split("=", 1)
+            ctx[k] = v
+
+        def ask_fn(k: str, prompt: str) -> str:
+            return click.prompt(prompt, type=str)
+
+        _run_script(script, flow, ctx, data, no_save, llm, ask_fn, click.echo)
+
+    return cli
+
+# ========= 快速路径：常规的 `run` 调用绕开 Click，用 argparse 解析 =========
+class _NoFastPath(Exception):
+    """参数不在快速路径覆盖范围内，交给 Click 处理（含帮助与报错信息）。"""
+
+def _fast_arg_parser():
+    import argparse
+
+    class Parser(argparse.ArgumentParser):
+        def error(self, message):
+            raise _NoFastPath(message)
+
+    # 选项与 Click 版 run 命令保持一致；Click 不接受选项缩写，这里也关掉
+    p = Parser(prog="agent-dsl run", add_help=False, allow_abbrev=False)
+    p.add_argument("script")
+    p.add_argument("--flow", default="main")
+    p.add_argument("--var", action="append", default=[])
+    p.add_argument("--data", type=Path)
+    p.add_argument("--no-save", action="store_true")
+    p.add_argument("--llm", choices=["none", "deepseek"], default="none")
+    return p
+
+def _prompt(prompt: str) -> str:
+    # 与 click.prompt(prompt, type=str) 的交互一致：追加 ": "，空输入重新提示
+    while True:
+        value = input(f"{prompt}: ")
+        if value:
+            return value
+
+def _fast_main(argv: Sequence[str]) -> bool:
+    """能处理则执行并返回 True；否则不产生任何副作用并返回 False。"""
+    if not argv or argv[0] != "run" or "--help" in argv or "-h" in argv:
+        return False
+    try:
+        ns = _fast_arg_parser().parse_args(argv[1:])
+    except _NoFastPath:
+        return False
+    script = Path(ns.script)
+    if not script.is_file():
+        return False
+    if ns.data is not None and ns.data.is_dir():   # Click 的 dir_okay=False：交给它报用法错误
+        return False
+    ctx: Dict[str, str] = {}
+    for item in ns.var:
+        if "=" not in item:
+            return False
+        k, v = item.split("=", 1)
+        ctx[k] = v
+
+    try:
+        _run_script(script, ns.flow, ctx, ns.data, ns.no_save, ns.llm,
+                    lambda k, prompt: _prompt(prompt), print)
+    except (EOFError, KeyboardInterrupt):
+        print(file=sys.stderr)
+        print("Aborted!", file=sys.stderr)
+        sys.exit(1)
+    return True
+
+def __getattr__(name: str):
+    # 兼容 `from agent_dsl.cli import cli`：按需构建 Click 命令组
+    if name == "cli":
+        return _build_click_cli()
+    raise AttributeError(name)
 
 def main() -> None:
-    cli()
+    if _fast_main(sys.argv[1:]):
+        return
+    _build_click_cli()()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,389 @@
+# src/agent_dsl/expr.py
+import ast
+import keyword
+import operator
+import sys
+from functools import lru_cache, partial
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# =========================
+# 表达式：解析期把 AST 编译成后缀指令序列，运行期用栈机执行（严格白名单）
+# =========================
+
+def parse_expr(expr: str) -> ast.Expression:
+    """把表达式解析为语法树并做静态校验。"""
+    tree = ast.parse(expr, mode="eval")
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Subscript, ast.Attribute)):
+            raise ValueError("不允许下标/属性访问")
+    return tree
+
+# 允许的算术运算：AST 运算符类型 -> 实现
+_ARITH = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+}
+
+_CMP_OPS = {ast.Eq: "==", ast.NotEq: "!=", ast.Gt: ">", ast.Lt: "<", ast.GtE: ">=", ast.LtE: "<="}
+
+# 名字 true/false/null（不区分大小写）是常量，其余名字读上下文
+_NAME_CONSTS = {"true": True, "false": False, "null": None}
+
+def _fn_len(x):    return len(str(x))
+def _fn_abs(x):    return abs(float(x))
+def _fn_int(x):    return int(float(x))
+def _fn_float(x):  return float(x)
+def _fn_str(x):    return str(x)
+def _fn_upper(x):  return str(x).upper()
+def _fn_lower(x):  return str(x).lower()
+def _fn_title(x):  return str(x).title()
+def _fn_trim(x):   return str(x).strip()
+def _fn_min(a, b): return min(float(a), float(b))
+def _fn_max(a, b): return max(float(a), float(b))
+# ⭐ 新增：子串包含
+def _fn_contains(h, n): return str(n) in str(h)
+
+_FUNC_WHITELIST = {
+    "len": _fn_len, "abs": _fn_abs,
+    "int": _fn_int, "float": _fn_float, "str": _fn_str,
+    "upper": _fn_upper, "lower": _fn_lower, "title": _fn_title, "trim": _fn_trim,
+    "min": _fn_min, "max": _fn_max,
+    "contains": _fn_contains,
+}
+
+# 字符串 -> float（不是数字为 None）的转换缓存：循环里反复比较的往往是同几个值，
+# 命中时省掉 float() 以及解析失败时的异常开销；超过上限整体清空
+_MISS = object()
+_NUM_CACHE_MAX = 8192
+_num_cache: Dict[str, Optional[float]] = {}
+
+def _to_number_maybe(v: Any) -> Optional[float]:
+    if isinstance(v, (int, float)):
+        return float(v)
+    s = str(v)
+    r = _num_cache.get(s, _MISS)
+    if r is _MISS:
+        # 首个非空白字符不可能开始一个数字（普通单词、空串）时直接判定，免去抛异常；
+        # 其余交给 float()，Unicode 数字、inf/nan 等写法照旧支持
+        c = s.lstrip()[:1]
+        if not c or not (c.isdecimal() or c in "+-.iInN"):
+            r = None
+        else:
+            try:
+                r = float(s)
+            except Exception:
+                r = None
+        if len(_num_cache) >= _NUM_CACHE_MAX:
+            _num_cache.clear()
+        _num_cache[s] = r
+    return r
+
+def _coerce_number(v: Any) -> Any:
+    n = _to_number_maybe(v)
+    return v if n is None else n
+
+_NUM_TYPES = (int, float, bool)
+
+# 比较符 -> C 实现的比较函数；数字与字符串两种比较共用
+_CMP_FUNCS = {
+    "==": operator.eq, "!=": operator.ne, ">": operator.gt,
+    "<": operator.lt, ">=": operator.ge, "<=": operator.le,
+}
+
+def _do_compare(a: Any, op: str, b: Any) -> bool:
+    fn = _CMP_FUNCS.get(op)
+    if fn is None:
+        raise ValueError(f"不支持的操作符：{op}")
+    return _compare_with(fn, a, b)
+
+def _compare_with(fn: Callable[[Any, Any], bool], a: Any, b: Any) -> bool:
+    """按已选定的比较函数比较：两侧都能转成数字时按数字，否则按字符串。"""
+    # 两侧已是数字（算术结果、字面量）：不走 str()/转换缓存
+    if a.__class__ in _NUM_TYPES and b.__class__ in _NUM_TYPES:
+        return fn(float(a), float(b))
+    fa = _to_number_maybe(a)
+    if fa is not None:
+        fb = _to_number_maybe(b)
+        if fb is not None:
+            return fn(fa, fb)
+    return fn(str(a), str(b))
+
+def _arith(fn, l: Any, r: Any) -> Any:
+    ln, rn = _coerce_number(l), _coerce_number(r)
+    if isinstance(ln, (int, float)) and isinstance(rn, (int, float)):
+        return fn(ln, rn)
+    if fn is operator.add and isinstance(l, str) and isinstance(r, str):
+        return l + r
+    raise ValueError("仅支持数字算术或字符串相加")
+
+# =========================
+# 指令：(opcode, 参数)；跳转参数为目标下标
+# 不被允许的写法编译成 FAIL：执行到该处才报错，和逐节点求值时的报错时机一致
+# =========================
+
+VAR, CONST, CMP, CMP_CHAIN, ARITH, CALL, TRUTH, NOT, NEG, POS, \
+    JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP, FAIL = range(13)
+
+Code = Tuple[Tuple[int, Any], ...]
+
+def _compile_value(node: ast.AST, out: List[list]) -> None:
+    t = type(node)
+    if t is ast.Name:
+        low = node.id.lower()
+        if low in _NAME_CONSTS:
+            out.append([CONST, _NAME_CONSTS[low]])
+        else:
+            out.append([VAR, sys.intern(node.id)])
+    elif t is ast.Constant:
+        out.append([CONST, node.value])
+    elif t is ast.BinOp and type(node.op) in _ARITH:
+        _compile_value(node.left, out)
+        _compile_value(node.right, out)
+        out.append([ARITH, _ARITH[type(node.op)]])
+    elif t is ast.Call:
+        if not (type(node.func) is ast.Name and node.func.id in _FUNC_WHITELIST):
+            out.append([FAIL, "仅允许白名单函数调用"])
+            return
+        for a in node.args:
+            _compile_value(a, out)
+        out.append([CALL, (_FUNC_WHITELIST[node.func.id], len(node.args))])
+    elif t is ast.UnaryOp and type(node.op) in (ast.UAdd, ast.USub):
+        _compile_value(node.operand, out)
+        out.append([NEG if type(node.op) is ast.USub else POS, None])
+    elif t is ast.Expression:
+        _compile_value(node.body, out)
+    else:
+        out.append([FAIL, f"表达式不被允许：{ast.dump(node, include_attributes=False)}"])
+
+def _compile_bool(node: ast.AST, out: List[list]) -> None:
+    t = type(node)
+    if t is ast.Compare:
+        # a < b < c：前面的比较失败就直接得到 False，不再求值后面的操作数
+        _compile_value(node.left, out)
+        jumps = []
+        last = len(node.ops) - 1
+        for i, (op, comp) in enumerate(zip(node.ops, node.comparators)):
+            _compile_value(comp, out)
+            sym = _CMP_OPS.get(type(op))
+            if sym is None:
+                out.append([FAIL, "比较运算仅支持 == != > < >= <="])
+                break
+            if i < last:
+                jumps.append(len(out))
+                out.append([CMP_CHAIN, [sym, None]])
+            else:
+                out.append([CMP, sym])
+        for j in jumps:
+            out[j][1] = (out[j][1][0], len(out))
+    elif t is ast.BoolOp:
+        jump = JUMP_IF_FALSE_OR_POP if type(node.op) is ast.And else JUMP_IF_TRUE_OR_POP
+        jumps = []
+        for i, v in enumerate(node.values):
+            _compile_bool(v, out)
+            if i < len(node.values) - 1:
+                jumps.append(len(out))
+                out.append([jump, None])
+        for j in jumps:
+            out[j][1] = len(out)
+    elif t is ast.UnaryOp and type(node.op) is ast.Not:
+        _compile_bool(node.operand, out)
+        out.append([NOT, None])
+    elif t in (ast.Constant, ast.Name, ast.BinOp, ast.UnaryOp, ast.Call):
+        _compile_value(node, out)
+        out.append([TRUTH, None])
+    elif t is ast.Expression:
+        _compile_bool(node.body, out)
+    else:
+        out.append([FAIL, f"不允许的布尔表达式：{ast.dump(node, include_attributes=False)}"])
+
+def _simple_value(expr: str) -> Optional[Code]:
+    """单个 ASCII 名字或十进制整数：结果与走 ast 完全相同，直接给出指令，不必调用解析器。"""
+    if not expr.isascii():
+        return None   # 非 ASCII 名字 ast 会做 NFKC 规范化，交给 ast
+    if expr.isidentifier():
+        if keyword.iskeyword(expr):
+            return None   # True/False/None 为常量，其余关键字是语法错误
+        low = expr.lower()
+        if low in _NAME_CONSTS:
+            return ((CONST, _NAME_CONSTS[low]),)
+        return ((VAR, sys.intern(expr)),)
+    if expr.isdigit() and (expr[0] != "0" or expr == "0"):
+        return ((CONST, int(expr)),)
+    return None
+
+# 编译结果是不可变元组，可在相同表达式串之间共享；解析失败的不缓存（每次重新抛出）
+@lru_cache(maxsize=512)
+def compile_value(expr: str) -> Code:
+    """编译取值表达式（set 右侧等）。"""
+    simple = _simple_value(expr)
+    if simple is not None:
+        return simple
+    out: List[list] = []
+    _compile_value(parse_expr(expr), out)
+    return tuple((op, arg) for op, arg in out)
+
+@lru_cache(maxsize=512)
+def compile_bool(expr: str) -> Code:
+    """编译条件表达式（if/elif），结果总是 bool。"""
+    simple = _simple_value(expr)
+    if simple is not None:
+        return simple + ((TRUTH, None),)
+    out: List[list] = []
+    _compile_bool(parse_expr(expr), out)
+    return tuple((op, arg) for op, arg in out)
+
+def is_constant(code: Code) -> bool:
+    """不读取任何变量（结果只取决于表达式本身）。"""
+    return all(op != VAR for op, _ in code)
+
+# =========================
+# 执行：指令序列一次性翻译成 Python 函数（调用同一组辅助函数，语义不变），
+# 由 CPython 直接执行；含 FAIL 或翻译失败（如嵌套过深）的退回栈机
+# =========================
+
+def _truth(v: Any) -> bool:
+    return v != 0 if isinstance(v, (int, float)) else bool(v)
+
+def _unary(v: Any, neg: bool) -> Any:
+    vn = _coerce_number(v)
+    if not isinstance(vn, (int, float)):
+        raise ValueError("一元正负仅支持数字")
+    return -vn if neg else +vn
+
+_INLINE_CONSTS = (int, str, bool, type(None))
+
+def _gen(code: Code, pc: int, end: int, stack: List[str], env: Dict[str, Any]) -> List[str]:
+    """把 code[pc:end] 翻译成源码表达式，压在 stack（源码串）上。"""
+    def const(v: Any) -> str:
+        if type(v) in _INLINE_CONSTS:
+            return repr(v)
+        name = f"_k{len(env)}"
+        env[name] = v
+        return name
+    while pc < end:
+        op, arg = code[pc]
+        pc += 1
+        if op == VAR:
+            stack.append(f"ctx.get({arg!r}, '')")
+        elif op == CONST:
+            stack.append(const(arg))
+        elif op == CMP:
+            # 比较函数直接作为常量写进源码，执行时不再按符号查表
+            r = stack.pop()
+            stack.append(f"_cmpf({const(_CMP_FUNCS[arg])}, {stack.pop()}, {r})")
+        elif op == ARITH:
+            r = stack.pop()
+            stack.append(f"_arith({const(arg)}, {stack.pop()}, {r})")
+        elif op == TRUTH:
+            stack.append(f"_truth({stack.pop()})")
+        elif op == NOT:
+            stack.append(f"(not {stack.pop()})")
+        elif op in (NEG, POS):
+            stack.append(f"_unary({stack.pop()}, {op == NEG})")
+        elif op == CALL:
+            fn, n = arg
+            args = stack[len(stack) - n:]
+            del stack[len(stack) - n:]
+            stack.append(f"{const(fn)}({', '.join(args)})")
+        elif op in (JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP):
+            # 跳转目标之前的指令恰好算出右操作数
+            rhs, = _gen(code, pc, arg, [], env)
+            word = "and" if op == JUMP_IF_FALSE_OR_POP else "or"
+            stack.append(f"({stack.pop()} {word} {rhs})")
+            pc = arg
+        elif op == CMP_CHAIN:
+            # a < b < c：中间操作数只求值一次，存进临时变量给后一个比较用
+            sym, target = arg
+            tmp = f"_t{len(env)}"
+            env[tmp] = None
+            r = stack.pop()
+            rest, = _gen(code, pc, target, [tmp], env)
+            stack.append(f"(_cmpf({const(_CMP_FUNCS[sym])}, {stack.pop()}, ({tmp} := {r})) and {rest})")
+            pc = target
+        else:  # FAIL：报错时机依赖栈机的执行顺序，不翻译
+            raise ValueError("FAIL")
+    return stack
+
+def _to_function(code: Code) -> Callable[[Dict[str, Any]], Any]:
+    env: Dict[str, Any] = {}
+    try:
+        expr, = _gen(code, 0, len(code), [], env)
+        glb = {"__builtins__": {}, "_cmpf": _compare_with, "_arith": _arith,
+               "_truth": _truth, "_unary": _unary}
+        glb.update((k, v) for k, v in env.items() if k.startswith("_k"))
+        exec(compile(f"def _expr(ctx):\n    return {expr}\n", "<expr>", "exec"), glb)
+        return glb["_expr"]
+    except Exception:
+        return partial(_run_vm, code)
+
+# id(code) -> (code, 函数)；保存 code 本身，防止 id 被复用后错配
+_FN_CACHE_MAX = 4096
+_fn_cache: Dict[int, Tuple[Code, Callable[[Dict[str, Any]], Any]]] = {}
+
+def as_function(code: Code) -> Callable[[Dict[str, Any]], Any]:
+    """取 code 对应的 fn(ctx)；翻译结果按 code 缓存。"""
+    ent = _fn_cache.get(id(code))
+    if ent is None or ent[0] is not code:
+        if len(_fn_cache) >= _FN_CACHE_MAX:
+            _fn_cache.clear()
+        ent = _fn_cache[id(code)] = (code, _to_function(code))
+    return ent[1]
+
+def run_code(code: Code, ctx: Dict[str, Any]) -> Any:
+    ent = _fn_cache.get(id(code))
+    if ent is not None and ent[0] is code:
+        return ent[1](ctx)
+    return as_function(code)(ctx)
+
+def _run_vm(code: Code, ctx: Dict[str, Any]) -> Any:
+    stack: List[Any] = []
+    push, pop = stack.append, stack.pop
+    pc, end = 0, len(code)
+    while pc < end:
+        op, arg = code[pc]
+        pc += 1
+        if op == VAR:
+            push(ctx.get(arg, ""))
+        elif op == CONST:
+            push(arg)
+        elif op == CMP:
+            r = pop()
+            stack[-1] = _do_compare(stack[-1], arg, r)
+        elif op == ARITH:
+            r = pop()
+            stack[-1] = _arith(arg, stack[-1], r)
+        elif op == TRUTH:
+            stack[-1] = _truth(stack[-1])
+        elif op == JUMP_IF_FALSE_OR_POP:
+            if stack[-1]:
+                pop()
+            else:
+                pc = arg
+        elif op == JUMP_IF_TRUE_OR_POP:
+            if stack[-1]:
+                pc = arg
+            else:
+                pop()
+        elif op == CMP_CHAIN:
+            sym, target = arg
+            r = pop()
+            if _do_compare(stack[-1], sym, r):
+                stack[-1] = r
+            else:
+                stack[-1] = False
+                pc = target
+        elif op == CALL:
+            fn, n = arg
+            if n:
+                args = stack[-n:]
+                del stack[-n:]
+                push(fn(*args))
+            else:
+                push(fn())
+        elif op == NOT:
+            stack[-1] = not stack[-1]
+        elif op == FAIL:
+            raise ValueError(arg)
+        else:  # NEG / POS
+            stack[-1] = _unary(stack[-1], op == NEG)
+    return stack[-1]
@@ -0,0 +1,80 @@
+# src/agent_dsl/jsonio.py
+import json
+import os
+import re
+import tempfile
+from typing import Any, Union
+
+# 可选加速：装了 orjson 就用它，否则退回标准库 json（行为一致）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 实现在导入时选定一次，调用时不再判断
+if orjson is not None:
+    _DUMPS_OPTS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+    # orjson 与标准库的差异：不接受 NaN/Infinity；超出 64 位的整数会被悄悄读成 float，
+    # 写出时 NaN 变成 null。含 19 位以上连续数字的文档直接交给标准库（宁可误判也不丢精度），
+    # orjson 报错时同样退回标准库
+    _LONG_DIGITS = re.compile(rb"[0-9]{19}")
+    _LONG_DIGITS_STR = re.compile(r"[0-9]{19}")
+
+    # 由标准库解析出的文档（顶层容器换成这两个子类作标记）可能含 orjson 无法原样写回的值，
+    # 写回时也用标准库
+    class _StdlibDict(dict): pass
+    class _StdlibList(list): pass
+    _STDLIB_WRAP = {dict: _StdlibDict, list: _StdlibList}
+
+    def loads(data: Union[bytes, str]) -> Any:
+        """解析 JSON；直接接受 read_bytes() 的结果，无需先解码成 str。"""
+        pat = _LONG_DIGITS_STR if data.__class__ is str else _LONG_DIGITS
+        if pat.search(data) is None:
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass
+        obj = json.loads(data)
+        wrap = _STDLIB_WRAP.get(obj.__class__)
+        return wrap(obj) if wrap is not None else obj
+
+    def dumps(obj: Any) -> bytes:
+        """序列化为缩进 2 格、保留非 ASCII 字符的 UTF-8 字节，可直接 write_bytes。"""
+        if obj.__class__ is not _StdlibDict and obj.__class__ is not _StdlibList:
+            try:
+                return orjson.dumps(obj, option=_DUMPS_OPTS)
+            except orjson.JSONEncodeError:
+                pass   # 例如超出 64 位的整数
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+else:
+    def loads(data: Union[bytes, str]) -> Any:
+        """解析 JSON；直接接受 read_bytes() 的结果，无需先解码成 str。"""
+        return json.loads(data)
+
+    def dumps(obj: Any) -> bytes:
+        """序列化为缩进 2 格、保留非 ASCII 字符的 UTF-8 字节，可直接 write_bytes。"""
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+def dump_file(path: Union[str, "os.PathLike[str]"], obj: Any) -> None:
+    """原子写入 JSON 文件：先写同目录下唯一命名的临时文件再替换目标，
+    写到一半被打断也不会留下损坏的文件；多个线程/进程同时写同一文件也互不干扰。"""
+    path = os.fspath(path)
+    data = dumps(obj)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                               prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # mkstemp 建的文件权限为 0600：已有文件沿用原权限，新文件按常规的 0644
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
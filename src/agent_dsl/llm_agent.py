@@ -1,9 +1,19 @@
 # src/agent_dsl/llm_agent.py
+import hashlib
 import json
-import requests
-from typing import Optional, List
+import time
+from collections import OrderedDict
+from typing import Optional, List, Dict, Tuple
 from pathlib import Path
 
+from .jsonio import dump_file, loads
+from .paths import app_dir
+
+# 磁盘缓存条目的格式版本与有效期：版本不符或过期的条目视为未命中（并删除）
+_DISK_CACHE_VERSION = 1
+_DISK_CACHE_TTL = 7 * 24 * 3600
+_MEMO_SIZE = 1024   # 内存 LRU 的条数上限
+
 class DeepSeekClient:
     """
     DeepSeek Chat API 调用。
@@ -12,23 +22,69 @@ class DeepSeekClient:
     """
     def __init__(self, model: str = "deepseek-chat"):
         self.model = model
-        self.api_key = self._load_api_key()
+        self._api_key: Optional[str] = None      # 首次使用时才读取 config.json
         self.api_url = "https://api.deepseek.com/v1/chat/completions"
+        self._lower_cache: Dict[str, str] = {}   # 候选状态名 -> 小写形式，跨调用复用
+        self._session = None                     # requests.Session，首次在线调用时创建
+        # 在线分类结果：内存 LRU -> 磁盘缓存 -> API；两级缓存都只保存命中的结果
+        self._memo: "OrderedDict[Tuple[str, Tuple[str, ...]], str]" = OrderedDict()
+
+    @property
+    def api_key(self) -> str:
+        if self._api_key is None:
+            self._api_key = self._load_api_key()
+        return self._api_key
+
+    def _get_session(self):
+        """复用同一个带连接池的 Session，多轮对话不必每次重新握手 TCP/TLS。"""
+        if self._session is None:
+            import requests  # 仅在线模式需要；离线演示与 --help 等路径不必加载
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            session = requests.Session()
+            session.headers.update({
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+            })
+            # 分类请求是 POST、不幂等：只在连接失败（请求未发出）或服务端明确返回
+            # 限流/错误状态码时重试，读超时不重试；429 按 Retry-After 等待
+            opts = dict(total=3, connect=2, read=0, status=3, backoff_factor=1.0,
+                        status_forcelist=[429, 500, 502, 503, 504],
+                        allowed_methods=None, respect_retry_after_header=True)
+            try:
+                retry = Retry(**opts, backoff_max=8.0)
+            except TypeError:   # urllib3 1.x 没有 backoff_max 参数，沿用其默认上限
+                retry = Retry(**opts)
+            session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4,
+                                                  max_retries=retry))
+            self._session = session
+        return self._session
 
     def _load_api_key(self) -> str:
         config_path = Path(__file__).resolve().parents[1] / "config.json"
         if config_path.exists():
             try:
-                cfg = json.loads(config_path.read_text(encoding="utf-8"))
+                cfg = loads(config_path.read_bytes())
                 key = cfg.get("deepseek_api_key")
                 if key:
-                    print(f"[DeepSeekClient] 从 config.json 读取到 API Key。")
                     return key
             except Exception as e:
                 print(f"[DeepSeekClient] 读取 config.json 出错：{e}")
         print("[DeepSeekClient] 未找到有效 API Key，使用离线演示模式。")
         return "DEMO_KEY_HERE"
 
+    def _lowered(self, candidates) -> List[Tuple[str, str]]:
+        """返回 (候选名, 小写形式) 列表；小写结果跨调用缓存。"""
+        lower_cache = self._lower_cache
+        pairs = []
+        for c in candidates:
+            low = lower_cache.get(c)
+            if low is None:
+                low = lower_cache[c] = c.lower()
+            pairs.append((c, low))
+        return pairs
+
     def classify_intent(
         self,
         user_input: str,
@@ -38,50 +94,167 @@ class DeepSeekClient:
         """返回最合适的目标状态；若失败返回 None。"""
         ex_set = set(exclude or [])            # ← 不覆盖参数名，单独用 ex_set
         candidates = [t for t in available_targets if t not in ex_set]
-        if not candidates:
+        if not candidates or not user_input.strip():
             return None
+        if len(candidates) == 1:
+            return candidates[0]   # 只剩一个候选，无需匹配或请求模型
 
         # 离线演示：简单关键字匹配
         if self.api_key == "DEMO_KEY_HERE":
             text = user_input.lower()
-            for t in candidates:
-                if t.lower() in text or text in t.lower():
+            for t, low in self._lowered(candidates):
+                if low in text or text in low:
                     return t
             return None
 
-        system_prompt = (
-            "你是一个智能意图分类器。"
-            "给定用户输入和候选状态名称，你需要从候选集中选择最可能匹配的状态。"
-            "只输出状态名称本身，不要解释。"
-        )
-        user_prompt = f"候选状态：{candidates}\n用户输入：{user_input}\n请返回最合适的状态名称："
+        try:
+            return self._classify_cached(user_input, tuple(candidates))
+        except Exception as e:
+            print(f"[DeepSeekClient] 调用失败：{e}")
+            return None
+
+    def _disk_cache_path(self, user_input: str, candidates: Tuple[str, ...]) -> Path:
+        key = json.dumps([self.model, user_input, candidates], ensure_ascii=False)
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return app_dir() / "llm_cache" / f"{digest}.json"
+
+    @staticmethod
+    def _read_disk_cache(cache_path: Path):
+        """命中返回 (True, result)，未命中、过期或文件损坏返回 (False, None)。"""
+        if cache_path.exists():
+            try:
+                entry = loads(cache_path.read_bytes())
+                if (entry.get("v") == _DISK_CACHE_VERSION
+                        and time.time() - entry["t"] < _DISK_CACHE_TTL
+                        and isinstance(entry["result"], str)):
+                    return True, entry["result"]
+                cache_path.unlink(missing_ok=True)   # 旧格式或已过期
+            except Exception:
+                pass  # 缓存文件损坏：重新请求并覆盖
+        return False, None
+
+    @staticmethod
+    def _write_disk_cache(cache_path: Path, result: Optional[str]) -> None:
+        # 采样有随机性（temperature=0.3），“没有匹配”不落盘，下次仍重新请求
+        if result is None:
+            return
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            dump_file(cache_path, {"v": _DISK_CACHE_VERSION, "t": time.time(), "result": result})
+        except OSError:
+            pass
+
+    def _classify_cached(self, user_input: str, candidates: Tuple[str, ...]) -> Optional[str]:
+        """内存 LRU：“没有匹配”（None）不记住，采样有随机性，下次仍重新请求。"""
+        key = (user_input, candidates)
+        memo = self._memo
+        result = memo.get(key)
+        if result is not None:
+            memo.move_to_end(key)
+            return result
+        result = self._classify_online(user_input, candidates)
+        if result is not None:
+            memo[key] = result
+            if len(memo) > _MEMO_SIZE:
+                memo.popitem(last=False)
+        return result
+
+    def _classify_online(self, user_input: str, candidates: Tuple[str, ...]) -> Optional[str]:
+        """内存 LRU 未命中时调用：先查磁盘缓存，再请求 API 并写回。
+        请求失败时抛出异常，失败结果不会进入任何一级缓存。"""
+        cache_path = self._disk_cache_path(user_input, candidates)
+        hit, result = self._read_disk_cache(cache_path)
+        if hit:
+            return result
+        result = self._request_intent(user_input, candidates)
+        self._write_disk_cache(cache_path, result)
+        return result
 
+    def _match_candidate(self, result: str, candidates: Tuple[str, ...]) -> Optional[str]:
+        """把模型输出映射回候选状态名。"""
+        # 优先精确/包含匹配候选集合
+        result_low = result.lower()
+        for cand, low in self._lowered(candidates):
+            if low == result_low or low in result_low:
+                return cand
+        token = (result.split() or [""])[0]
+        return token if token in candidates else None
+
+    def _post_chat(self, system_prompt: str, user_prompt: str, max_tokens: int, **extra) -> str:
         payload = {
             "model": self.model,
             "messages": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
             ],
-            "max_tokens": 20,
+            "max_tokens": max_tokens,
             "temperature": 0.3,
+            **extra,
         }
+        resp = self._get_session().post(self.api_url, json=payload, timeout=15)
+        resp.raise_for_status()
+        data = resp.json()
+        return data["choices"][0]["message"]["content"].strip()
 
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
+    def _request_intent(self, user_input: str, candidates: Tuple[str, ...]) -> Optional[str]:
+        system_prompt = (
+            "你是一个智能意图分类器。"
+            "给定用户输入和候选状态名称，你需要从候选集中选择最可能匹配的状态。"
+            "只输出状态名称本身，不要解释。"
+        )
+        user_prompt = f"候选状态：{list(candidates)}\n用户输入：{user_input}\n请返回最合适的状态名称："
+        return self._match_candidate(self._post_chat(system_prompt, user_prompt, 20), candidates)
 
+    def classify_intents_batch(
+        self,
+        items: List[Tuple[str, List[str]]],
+    ) -> List[Optional[str]]:
+        """
+        批量分类：items 为 [(用户输入, 候选状态列表), ...]，按序返回结果。
+        缓存未命中的条目合并为一次 API 调用（共用一份系统提示）；失败的条目返回 None。
+        """
+        if self.api_key == "DEMO_KEY_HERE":
+            return [self.classify_intent(u, c) for u, c in items]
+
+        results: List[Optional[str]] = [None] * len(items)
+        pending: List[Tuple[int, str, Tuple[str, ...], Path]] = []
+        for idx, (user_input, cands) in enumerate(items):
+            candidates = tuple(cands)
+            if not candidates:
+                continue
+            cache_path = self._disk_cache_path(user_input, candidates)
+            hit, result = self._read_disk_cache(cache_path)
+            if hit:
+                results[idx] = result
+            else:
+                pending.append((idx, user_input, candidates, cache_path))
+        if not pending:
+            return results
+
+        system_prompt = (
+            "你是一个智能意图分类器。"
+            "对每条用户输入，从它自己的候选状态中选择最可能匹配的状态。"
+            '只输出 JSON 对象 {"results": [...]}，数组按输入顺序给出状态名称，不要解释。'
+        )
+        lines = [f"{n}. 候选={list(c)} 输入={u}" for n, (_, u, c, _) in enumerate(pending, 1)]
+        user_prompt = (f"请对以下 {len(pending)} 条输入分别选择候选状态，按序返回 JSON：\n"
+                       + "\n".join(lines))
         try:
-            resp = requests.post(self.api_url, headers=headers, json=payload, timeout=15)
-            resp.raise_for_status()
-            data = resp.json()
-            result = data["choices"][0]["message"]["content"].strip()
-            # 优先精确/包含匹配候选集合
-            for cand in candidates:
-                if cand.lower() == result.lower() or cand.lower() in result.lower():
-                    return cand
-            token = (result.split() or [""])[0]
-            return token if token in candidates else None
+            content = self._post_chat(system_prompt, user_prompt, 20 * len(pending),
+                                      response_format={"type": "json_object"})
+            answers = loads(content)["results"]
         except Exception as e:
-            print(f"[DeepSeekClient] 调用失败：{e}")
-            return None
+            print(f"[DeepSeekClient] 批量调用失败：{e}")
+            return results
+        # 条数对不上就无法确定对应关系：整批按失败处理，不写缓存
+        if not isinstance(answers, list) or len(answers) != len(pending):
+            print(f"[DeepSeekClient] 批量调用返回格式不符：期望 {len(pending)} 条结果")
+            return results
+
+        for (idx, _, candidates, cache_path), answer in zip(pending, answers):
+            if not isinstance(answer, str):
+                continue
+            result = self._match_candidate(answer, candidates)
+            results[idx] = result
+            self._write_disk_cache(cache_path, result)
+        return results
@@ -1,32 +1,222 @@
-from dataclasses import dataclass, field
-from typing import Dict, List, Any
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Callable, ClassVar, Iterable, Optional, Tuple
 import re
+import sys
 
-@dataclass
+from .expr import Code, compile_bool, compile_value, is_constant, run_code
+from .template import Segment, compile_template
+
+# Program 结构版本：改动 Action/State/Flow/Program 的形状时递增，
+# 用于让磁盘上的解析缓存（见 cli）自动失效
+PROGRAM_FORMAT = 9
+
+# =========================
+# 动作：每种语句一个带 __slots__ 的不可变记录，字段即参数
+# （kind/opcode 为类属性；opcode 是 ACTION_TYPES 中的下标，运行时按它查表分发）
+# =========================
+
+@dataclass(slots=True, frozen=True)
 class Action:
-    kind: str
-    args: Dict[str, Any] = field(default_factory=dict)
+    kind: ClassVar[str] = ""
+    opcode: ClassVar[int] = -1
+
+@dataclass(slots=True, frozen=True)
+class ReplyAction(Action):
+    kind: ClassVar[str] = "reply"
+    opcode: ClassVar[int] = 0
+    text: str
+    segments: Tuple[Segment, ...]             # compile_template(text) 的结果
+
+@dataclass(slots=True, frozen=True)
+class GotoAction(Action):
+    kind: ClassVar[str] = "goto"
+    opcode: ClassVar[int] = 1
+    target: str
+    # 解析结束后由 _resolve_targets 填入目标 State（不参与比较/打印，避免循环引用）
+    target_state: Optional["State"] = field(default=None, repr=False, compare=False)
+
+    def __reduce__(self):
+        # pickle 只存目标名，不沿跳转链递归；Program 反序列化时重新解析
+        return (GotoAction, (self.target,))
+
+@dataclass(slots=True, frozen=True)
+class AskAction(Action):
+    kind: ClassVar[str] = "ask"
+    opcode: ClassVar[int] = 2
+    var: str
+    prompt: str
+
+@dataclass(slots=True, frozen=True)
+class SetAction(Action):
+    kind: ClassVar[str] = "set"
+    opcode: ClassVar[int] = 3
+    var: str
+    value: str
+
+@dataclass(slots=True, frozen=True)
+class SetExprAction(Action):
+    kind: ClassVar[str] = "set_expr"
+    opcode: ClassVar[int] = 4
+    var: str
+    expr: str
+    code: Code                                # 解析期编译好的指令序列
+
+@dataclass(slots=True, frozen=True)
+class IfGotoAction(Action):
+    kind: ClassVar[str] = "if_goto"
+    opcode: ClassVar[int] = 5
+    left: str
+    right: str
+    target: str
+    target_state: Optional["State"] = field(default=None, repr=False, compare=False)
+
+    def __reduce__(self):
+        return (IfGotoAction, (self.left, self.right, self.target))
+
+@dataclass(slots=True, frozen=True)
+class Branch:
+    """if/elif 的一个分支：条件原文、编译好的条件指令与分支体。"""
+    cond: str
+    code: Code
+    actions: List[Action]
+
+@dataclass(slots=True, frozen=True)
+class IfChainAction(Action):
+    kind: ClassVar[str] = "if_chain"
+    opcode: ClassVar[int] = 6
+    branches: List[Branch]
+    else_: Optional[List[Action]] = None
+
+@dataclass(slots=True, frozen=True)
+class IfBlockAction(Action):
+    """旧版单条件块（解析器已不再生成，运行时保留兼容）。"""
+    kind: ClassVar[str] = "if_block"
+    opcode: ClassVar[int] = 7
+    left: str
+    op: str
+    right: str
+    then: List[Action]
+    else_: Optional[List[Action]] = None
+
+@dataclass(slots=True, frozen=True)
+class SaveAction(Action):
+    kind: ClassVar[str] = "save"
+    opcode: ClassVar[int] = 8
+    var: str
+    path: str
+
+@dataclass(slots=True, frozen=True)
+class LoadAction(Action):
+    kind: ClassVar[str] = "load"
+    opcode: ClassVar[int] = 9
+    var: str
+    path: str
+
+@dataclass(slots=True, frozen=True)
+class EndAction(Action):
+    """状态结束标记：只出现在 Flow.code 中每个状态动作的末尾。"""
+    kind: ClassVar[str] = "end"
+    opcode: ClassVar[int] = 10
+
+_END = EndAction()
 
-@dataclass
+@dataclass(slots=True, frozen=True)
+class BranchAction(Action):
+    """条件不成立时跳到 else_pc（由 lower_flow 把 if_chain 展开而来）。"""
+    kind: ClassVar[str] = "branch"
+    opcode: ClassVar[int] = 11
+    code: Code
+    else_pc: int
+
+@dataclass(slots=True, frozen=True)
+class JumpAction(Action):
+    """无条件跳到 target_pc（分支体执行完后跳过其余分支）。"""
+    kind: ClassVar[str] = "jump"
+    opcode: ClassVar[int] = 12
+    target_pc: int
+
+# 按 opcode 排列
+ACTION_TYPES = (ReplyAction, GotoAction, AskAction, SetAction, SetExprAction,
+                IfGotoAction, IfChainAction, IfBlockAction, SaveAction, LoadAction,
+                EndAction, BranchAction, JumpAction)
+
+@dataclass(slots=True)
 class State:
     name: str
     actions: List[Action] = field(default_factory=list)
+    offset: int = field(default=-1, repr=False, compare=False)   # 本状态在 Flow.code 中的起点
 
-@dataclass
+@dataclass(slots=True)
 class Flow:
     name: str
     states: Dict[str, State] = field(default_factory=dict)
+    # 整个 flow 的扁平指令序列：各状态的动作首尾相接，每段以 EndAction 结尾；
+    # 由 lower_flow 生成，不参与 pickle（反序列化时重新生成）
+    code: List[Action] = field(default_factory=list, repr=False, compare=False)
+    # 与 code 逐条对齐的处理函数（runtime 首次执行时按 opcode 填充），同样不参与 pickle
+    handlers: Tuple[Callable, ...] = field(default=(), repr=False, compare=False)
+    # 状态名 -> 为该状态生成的 Python 函数（runtime 填充，生成失败为 None），同样不参与 pickle
+    funcs: Dict[str, Optional[Callable]] = field(default_factory=dict, repr=False, compare=False)
 
-@dataclass
+    def __reduce__(self):
+        return (Flow, (self.name, self.states))
+
+@dataclass(slots=True)
 class Program:
     flows: Dict[str, Flow] = field(default_factory=dict)
 
-# 旧：行内 if（保持兼容）
-_IF_GOTO = re.compile(r'^if\s+(.+?)==\s*(.+?)\s+goto\s+(.+?)$')
+    def __reduce__(self):
+        return (_rebuild_program, (self.flows,))
+
+# 单行语句按首个单词查表分发；只有 save/load/旧式 if 的参数需要正则切分
+_SAVE_ARGS = re.compile(r'\s+(.*?)\s+to\s+(.+)')
+_LOAD_ARGS = re.compile(r'\s+(.*?)\s+from\s+(.+)')
+_IF_GOTO_ARGS = re.compile(r'\s+(.+?)==\s*(.+?)\s+goto\s+(.+?)')
+
+def _first_word(raw: str) -> Tuple[str, str]:
+    """拆成（关键字, 其余部分）；raw 已 strip，其余部分要么为空，要么以空白开头。"""
+    head = raw.split(None, 1)[0]
+    return head, raw[len(head):]
+
+# 关键字正确但参数不合法时的提示
+_SYNTAX_ERRORS = {
+    "set":  'set 语法: set <var> = <expr或"字符串">',
+    "save": 'save 语法: save <var> to "file.json"',
+    "load": 'load 语法: load <var> from "file.json"',
+}
 
 # 新：块式 if/elif/else（按“条件整体”保存，运行期求值）
-_IF_HEAD   = re.compile(r'^if\s+(.+?)\s*\{$')
-_ELIF_HEAD = re.compile(r'^elif\s+(.+?)\s*\{$')
+# 块头 `if <cond> {` / `elif <cond> {` 用首尾判断直接切出条件，不走正则回溯
+def _block_head(raw: str, kw: str) -> Optional[str]:
+    """raw 形如 `<kw> <cond> {` 时返回 cond，否则返回 None。"""
+    k = len(kw)
+    if raw.endswith("{") and raw.startswith(kw) and raw[k:k + 1].isspace():
+        return raw[k:-1].strip() or None
+    return None
+
+def _const_truth(code: Code) -> Optional[bool]:
+    """条件不读取任何变量时在解析期求值一次；读取变量或求值出错返回 None（留到运行期）。"""
+    if not is_constant(code):
+        return None
+    try:
+        return run_code(code, {})
+    except Exception:
+        return None
+
+def _fold_if_chain(branches: List["Branch"], else_: Optional[List[Action]]) -> List[Action]:
+    """恒假分支丢弃；遇到恒真分支则它成为 else、其后分支全部丢弃。
+    没有剩余分支时直接返回要执行的动作，由调用方拼接进外层动作列表。"""
+    kept = []
+    for br in branches:
+        truth = _const_truth(br.code)
+        if truth is None:
+            kept.append(br)
+        elif truth:
+            else_ = br.actions
+            break
+    if kept:
+        return [IfChainAction(kept, else_)]
+    return list(else_ or [])
 
 def _unquote(val: str) -> str:
     v = val.strip()
@@ -34,20 +224,162 @@ def _unquote(val: str) -> str:
         return v[1:-1]
     return v
 
+# =========================
+# 单行语句处理器：入参为关键字之后的部分（含前导空白），返回 Action；参数不合法返回 None
+# 状态名/变量名一律 sys.intern，运行期 ctx/states 字典查找可走指针比较
+# =========================
+
+def _h_reply(rest: str) -> Optional[Action]:
+    if not rest:
+        return None
+    text = _unquote(rest)
+    return ReplyAction(text, compile_template(text))
+
+def _h_goto(rest: str) -> Optional[Action]:
+    return GotoAction(sys.intern(rest.strip())) if rest else None
+
+def _h_ask(rest: str) -> Optional[Action]:
+    parts = rest.split(None, 1)
+    if len(parts) < 2:
+        return None
+    return AskAction(sys.intern(parts[0]), _unquote(parts[1]))
+
+def _h_set(rest: str) -> Optional[Action]:
+    # 右侧可以是字符串常量或任意表达式
+    var, eq, rhs = rest.partition("=")
+    if not eq:
+        return None
+    var, rhs = sys.intern(var.strip()), rhs.lstrip()
+    if rhs.startswith('"') and rhs.endswith('"'):
+        return SetAction(var, _unquote(rhs))
+    return SetExprAction(var, rhs, compile_value(rhs))
+
+def _h_if(rest: str) -> Optional[Action]:
+    # 旧式行内 if_goto（保留兼容）；块式 if 由 parse_block_actions 处理
+    m = _IF_GOTO_ARGS.fullmatch(rest)
+    if m is None:
+        return None
+    return IfGotoAction(sys.intern(m[1].strip()), _unquote(m[2]), sys.intern(m[3].strip()))
+
+def _h_save(rest: str) -> Optional[Action]:
+    m = _SAVE_ARGS.fullmatch(rest)
+    if m is None:
+        return None
+    return SaveAction(sys.intern(m[1].strip()), _unquote(m[2]))
+
+def _h_load(rest: str) -> Optional[Action]:
+    m = _LOAD_ARGS.fullmatch(rest)
+    if m is None:
+        return None
+    return LoadAction(sys.intern(m[1].strip()), _unquote(m[2]))
+
+_HANDLERS: Dict[str, Callable[[str], Optional[Action]]] = {
+    "reply": _h_reply,
+    "goto":  _h_goto,
+    "ask":   _h_ask,
+    "set":   _h_set,
+    "if":    _h_if,
+    "save":  _h_save,
+    "load":  _h_load,
+}
+
+class _LineCursor:
+    """源码行游标：每行在读入时 strip 一次，只保留当前行（单行前瞻）。"""
+    __slots__ = ("_it", "line", "eof")
+
+    def __init__(self, lines: Iterable[str]):
+        self._it = iter(lines)
+        self.line = ""
+        self.eof = False
+        self.advance()
+
+    def advance(self) -> None:
+        nxt = next(self._it, None)
+        if nxt is None:
+            self.line = ""
+            self.eof = True
+        else:
+            self.line = nxt.strip()
+
+def _resolve_targets(actions: List[Action], states: Dict[str, State]) -> None:
+    """把 goto/if_goto 的目标名换成同一 flow 内的 State 对象（原地替换列表元素）。"""
+    for i, act in enumerate(actions):
+        if isinstance(act, (GotoAction, IfGotoAction)):
+            st = states.get(act.target)
+            if st is None:
+                raise KeyError(f"goto 的目标状态不存在：{act.target}")
+            actions[i] = replace(act, target_state=st)
+        elif isinstance(act, IfChainAction):
+            for br in act.branches:
+                _resolve_targets(br.actions, states)
+            if act.else_:
+                _resolve_targets(act.else_, states)
+        elif isinstance(act, IfBlockAction):
+            _resolve_targets(act.then, states)
+            if act.else_:
+                _resolve_targets(act.else_, states)
+
+def _emit(actions: List[Action], code: List[Action]) -> None:
+    """把动作追加到扁平指令序列；if_chain 展开为 Branch/Jump，不再递归执行子列表。"""
+    for act in actions:
+        if not isinstance(act, IfChainAction):
+            code.append(act)
+            continue
+        ends = []
+        last = len(act.branches) - 1
+        for i, br in enumerate(act.branches):
+            at = len(code)
+            code.append(_END)                 # 占位，分支体长度确定后回填
+            _emit(br.actions, code)
+            if i < last or act.else_:
+                ends.append(len(code))
+                code.append(_END)
+            code[at] = BranchAction(br.code, len(code))
+        if act.else_:
+            _emit(act.else_, code)
+        for j in ends:
+            code[j] = JumpAction(len(code))
+
+def lower_flow(flow: Flow) -> None:
+    """生成 Flow.code 并记录各状态的起点 offset。"""
+    code: List[Action] = []
+    for st in flow.states.values():
+        st.offset = len(code)
+        _emit(st.actions, code)
+        code.append(_END)
+    flow.code = code
+    flow.handlers = ()
+    flow.funcs = {}
+
+def _resolve_program(prog: Program) -> Program:
+    for fl in prog.flows.values():
+        for st in fl.states.values():
+            _resolve_targets(st.actions, fl.states)
+        lower_flow(fl)
+    return prog
+
+def _rebuild_program(flows: Dict[str, Flow]) -> Program:
+    """反序列化入口：跳转目标不随 pickle 保存，在这里重新解析。"""
+    return _resolve_program(Program(flows))
+
 def parse(text: str) -> Program:
-    lines = [ln.rstrip() for ln in text.splitlines()]
+    return parse_stream(text.splitlines())
+
+def parse_stream(lines: Iterable[str]) -> Program:
+    """
+    逐行解析：lines 可以是任意行迭代器（如打开的文件对象），
+    解析过程只持有当前一行，不要求整份源文本常驻内存。
+    """
+    src = _LineCursor(lines)
     prog = Program()
-    i = 0
-    n = len(lines)
 
     def parse_block_actions() -> List[Action]:
         """解析直到遇到 '}' 或 下一个 state/flow/elif/else。"""
-        nonlocal i
         actions: List[Action] = []
-        while i < n:
-            raw = lines[i].strip()
+        while not src.eof:
+            raw = src.line
             if not raw or raw.startswith("#"):
-                i += 1
+                src.advance()
                 continue
 
             # 子块终止信号
@@ -56,204 +388,107 @@ def parse(text: str) -> Program:
                 break
 
             # ---- if/elif/else 链处理为 if_chain ----
-            m_if = _IF_HEAD.match(raw)
-            if m_if:
-                i += 1
-                cond_if = m_if.group(1).strip()
-
-                # 解析 then-block
-                then_actions: List[Action] = []
-                while i < n and not lines[i].strip().startswith("}"):
-                    sub = parse_block_actions()
-                    if sub:
-                        then_actions.extend(sub)
-                    if i < n and lines[i].strip().startswith("}"):
-                        break
-                if i >= n:
+            head, rest = _first_word(raw)
+            cond_if = _block_head(raw, "if") if head == "if" else None
+            if cond_if is not None:
+                src.advance()
+
+                # 解析 then-block：parse_block_actions 会停在 '}' / '} elif' / '} else'
+                # （或 state/flow/文件末尾，即缺少右括号）上，块体只需扫描一遍
+                then_actions = parse_block_actions()
+                if src.eof:
                     raise ValueError("缺少 if 的右括号 '}'")
 
-                cur = lines[i].strip()
+                cur = src.line
                 if cur == "}":
-                    i += 1
+                    src.advance()
                 elif cur.startswith("} elif") or cur.startswith("} else"):
                     pass
                 else:
                     raise ValueError("缺少 if 的右括号 '}'")
 
                 # 收集 elif
-                branches = [{"cond": cond_if, "actions": then_actions}]
-                while i < n:
-                    look = lines[i].strip()
+                branches = [Branch(cond_if, compile_bool(cond_if), then_actions)]
+                while not src.eof:
+                    look = src.line
                     if look.startswith("} elif"):
                         part = look[len("} elif"):].strip()
                         if not part.endswith("{"):
                             raise ValueError("elif 语法错误，应为 `} elif <cond> {`")
                         cond = part[:-1].strip()
-                        i += 1
+                        src.advance()
                     else:
-                        m2 = _ELIF_HEAD.match(look)
-                        if m2:
-                            cond = m2.group(1).strip()
-                            i += 1
+                        cond = _block_head(look, "elif")
+                        if cond is not None:
+                            src.advance()
                         else:
                             break
 
-                    elif_actions: List[Action] = []
-                    while i < n and not lines[i].strip().startswith("}"):
-                        sub = parse_block_actions()
-                        if sub:
-                            elif_actions.extend(sub)
-                        if i < n and lines[i].strip().startswith("}"):
-                            break
-                    if i >= n:
+                    elif_actions = parse_block_actions()
+                    if src.eof:
                         raise ValueError("缺少 elif 的右括号 '}'")
-                    if lines[i].strip() == "}":
-                        i += 1
-                    elif lines[i].strip().startswith("} elif") or lines[i].strip().startswith("} else"):
+                    cur = src.line
+                    if cur == "}":
+                        src.advance()
+                    elif cur.startswith("} elif") or cur.startswith("} else"):
                         pass
                     else:
                         raise ValueError("缺少 elif 的右括号 '}'")
-                    branches.append({"cond": cond, "actions": elif_actions})
+                    branches.append(Branch(cond, compile_bool(cond), elif_actions))
 
-                # 可选 else
+                # 可选 else（文件末尾时 src.line 为空串，不会命中任何分支）
                 else_actions = None
-                if i < n:
-                    look = lines[i].strip()
-                    if look.startswith("} else"):
-                        i += 1
-                        else_actions = []
-                        while i < n and lines[i].strip() != "}":
-                            sub = parse_block_actions()
-                            if sub:
-                                else_actions.extend(sub)
-                            if i < n and lines[i].strip() == "}":
-                                break
-                        if i >= n or lines[i].strip() != "}":
-                            raise ValueError("缺少 else 的右括号 '}'")
-                        i += 1
-                    elif look.startswith("else"):
-                        line = look
-                        if line == "else {":
-                            i += 1
-                        elif line == "else":
-                            i += 1
-                            if i >= n or lines[i].strip() != "{":
-                                raise ValueError("else 后应为 '{'")
-                            i += 1
-                        else:
-                            raise ValueError("else 用法：else { ... }")
-                        else_actions = []
-                        while i < n and lines[i].strip() != "}":
-                            sub = parse_block_actions()
-                            if sub:
-                                else_actions.extend(sub)
-                            if i < n and lines[i].strip() == "}":
-                                break
-                        if i >= n or lines[i].strip() != "}":
-                            raise ValueError("缺少 else 的右括号 '}'")
-                        i += 1
-
-                actions.append(Action("if_chain", {
-                    "branches": branches,
-                    "else": else_actions
-                }))
-                continue
-
-            # ---- 普通语句 ----
-            if raw.startswith("reply "):
-                val = _unquote(raw[len("reply "):])
-                actions.append(Action("reply", {"text": val}))
-                i += 1
-                continue
-
-            if raw.startswith("goto "):
-                target = raw.split(" ", 1)[1].strip()
-                actions.append(Action("goto", {"target": target}))
-                i += 1
-                continue
-
-            if raw.startswith("ask "):
-                rest = raw[len("ask "):].strip()
-                var, prompt = rest.split(" ", 1)
-                actions.append(Action("ask", {"var": var, "prompt": _unquote(prompt)}))
-                i += 1
-                continue
-
-            if raw.startswith("set "):
-                # 新：右侧可以是字符串常量或任意表达式
-                rest = raw[len("set "):].strip()
-                if "=" not in rest:
-                    raise ValueError('set 语法: set <var> = <expr或"字符串">')
-                var, rhs = rest.split("=", 1)
-                var = var.strip()
-                rhs = rhs.strip()
-                if rhs.startswith('"') and rhs.endswith('"'):
-                    actions.append(Action("set", {"var": var, "value": _unquote(rhs)}))
+                look = src.line
+                has_else = True
+                if look.startswith("} else") or look == "else {":
+                    src.advance()
+                elif look == "else":
+                    src.advance()
+                    if src.eof or src.line != "{":
+                        raise ValueError("else 后应为 '{'")
+                    src.advance()
+                elif look.startswith("else"):
+                    raise ValueError("else 用法：else { ... }")
                 else:
-                    actions.append(Action("set_expr", {"var": var, "expr": rhs}))
-                i += 1
-                continue
-
-            # 旧式行内 if_goto（保留兼容）
-            m_legacy = _IF_GOTO.match(raw)
-            if m_legacy:
-                left, right, target = m_legacy.group(1).strip(), _unquote(m_legacy.group(2)), m_legacy.group(3).strip()
-                actions.append(Action("if_goto", {"left": left, "right": right, "target": target}))
-                i += 1
-                continue
-
-            if raw.startswith("save "):
-                rest = raw[len("save "):].strip()
-                if " to " not in rest:
-                    raise ValueError('save 语法: save <var> to "file.json"')
-                var, path = rest.split(" to ", 1)
-                actions.append(Action("save", {"var": var.strip(), "path": _unquote(path)}))
-                i += 1
-                continue
+                    has_else = False
+                if has_else:
+                    else_actions = parse_block_actions()
+                    if src.eof or src.line != "}":
+                        raise ValueError("缺少 else 的右括号 '}'")
+                    src.advance()
 
-            if raw.startswith("load "):
-                rest = raw[len("load "):].strip()
-                if " from " not in rest:
-                    raise ValueError('load 语法: load <var> from "file.json"')
-                var, path = rest.split(" from ", 1)
-                actions.append(Action("load", {"var": var.strip(), "path": _unquote(path)}))
-                i += 1
+                actions.extend(_fold_if_chain(branches, else_actions))
                 continue
 
-            raise ValueError(f"无法识别的语句：{raw}")
+            # ---- 普通语句：按关键字查表构造 ----
+            handler = _HANDLERS.get(head)
+            act = handler(rest) if handler is not None else None
+            if act is None:
+                raise ValueError(_SYNTAX_ERRORS.get(head, f"无法识别的语句：{raw}"))
+            actions.append(act)
+            src.advance()
+            continue
 
         return actions
 
-    while i < n:
-        raw = lines[i].strip()
-        if not raw or raw.startswith("#"):
-            i += 1
-            continue
-
-        if raw.startswith("flow "):
-            flow_name = raw.split(" ", 1)[1].strip()
+    # 顶层单循环：flow 行切换当前 flow，state 行解析一个状态，其余行（空行、注释等）跳过
+    flow: Optional[Flow] = None
+    while not src.eof:
+        raw = src.line
+        if raw.startswith("state "):
+            if flow is None:
+                raise ValueError("state 必须出现在 flow 内")
+            st_name = sys.intern(raw.split(" ", 1)[1].strip())
+            src.advance()
+            flow.states[st_name] = State(st_name, parse_block_actions())
+        elif raw.startswith("flow "):
+            flow_name = sys.intern(raw.split(" ", 1)[1].strip())
             flow = Flow(flow_name)
             prog.flows[flow_name] = flow
-            i += 1
-            while i < n:
-                ln = lines[i].strip()
-                if ln.startswith("state "):
-                    st_name = ln.split(" ", 1)[1].strip()
-                    i += 1
-                    state = State(st_name)
-                    state.actions = parse_block_actions()
-                    flow.states[st_name] = state
-                    continue
-                if ln.startswith("flow "):
-                    break
-                i += 1
-            continue
-
-        if raw.startswith("state "):
-            raise ValueError("state 必须出现在 flow 内")
-
-        i += 1
+            src.advance()
+        else:
+            src.advance()
 
     if not prog.flows:
         raise ValueError("至少需要一个 flow")
-    return prog
+    return _resolve_program(prog)
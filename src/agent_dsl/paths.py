@@ -0,0 +1,36 @@
+# src/agent_dsl/paths.py
+import os
+import sys
+from pathlib import Path
+
+APP_NAME = "agent_dsl"
+
+def app_dir() -> Path:
+    """
+    用户级数据目录（LLM 缓存等）。
+    规则与 click.get_app_dir(APP_NAME) 完全一致，但不需要导入 click，
+    这样 CLI 快速路径与 Click 路径共用同一份缓存。
+    """
+    if sys.platform.startswith("win"):
+        folder = os.environ.get("APPDATA")
+        if folder is None:
+            folder = os.path.expanduser("~")
+        return Path(folder) / APP_NAME
+    if sys.platform == "darwin":
+        return Path(os.path.expanduser("~/Library/Application Support")) / APP_NAME
+    return Path(os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config"))) / APP_NAME
+
+def cache_dir() -> Path:
+    """
+    用户级缓存目录（可随时清空的数据，如解析缓存）：
+    Linux 等遵循 XDG_CACHE_HOME（默认 ~/.cache），macOS 为 ~/Library/Caches，
+    Windows 为 %LOCALAPPDATA% 下的 agent_dsl/Cache。
+    """
+    if sys.platform.startswith("win"):
+        folder = os.environ.get("LOCALAPPDATA") or os.environ.get("APPDATA")
+        if folder is None:
+            folder = os.path.expanduser("~")
+        return Path(folder) / APP_NAME / "Cache"
+    if sys.platform == "darwin":
+        return Path(os.path.expanduser("~/Library/Caches")) / APP_NAME
+    return Path(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))) / APP_NAME
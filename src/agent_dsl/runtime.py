@@ -1,10 +1,27 @@
 # src/agent_dsl/runtime.py
-from typing import Iterable, Dict, Any, List, Optional, Callable, Tuple
-import ast
-import json
-import re
-from pathlib import Path
-from .parser import Program, Flow, Action
+from typing import Iterable, Dict, Any, List, Optional, Callable, Set, Tuple
+import os
+import sys
+from collections import defaultdict
+from .expr import _CMP_FUNCS, _do_compare, _to_number_maybe, as_function, compile_value, run_code
+from .jsonio import dump_file, loads
+from .parser import (
+    Program, Flow, State, Action, ACTION_TYPES, lower_flow,
+    ReplyAction, GotoAction, AskAction, SetAction, SetExprAction,
+    IfGotoAction, IfChainAction, IfBlockAction, SaveAction, LoadAction, EndAction,
+    BranchAction, JumpAction,
+)
+from .template import render
+
+# 可选：大文件 load 时用 ijson 流式取出目标键，不解析整份文档
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+_STREAM_THRESHOLD = 64 * 1024   # 超过该大小的文件才走流式 load
+_MISSING = object()
+_BROKEN = object()   # 文档缓存中的标记：文件存在但解析失败，本次运行既不读也不写它
 
 # 可选导入 LLM
 try:
@@ -13,261 +30,252 @@ except Exception:
     DeepSeekClient = None  # 允许没有 llm_agent.py 时正常运行（不启用 LLM）
 
 # =========================
-# 字符串插值（支持过滤器管道）
+# 表达式：编译与栈机执行见 expr.py
 # =========================
 
-_VAR_TAG_RE = re.compile(r"\{\{\s*(.*?)\s*\}\}")
-
-def _unescape_filter_arg(text: str) -> str:
-    return text.replace(r'\"', '"').replace(r'\\', '\\')
-
-def _apply_filter(value: Any, filt: str, arg: Optional[str]) -> Any:
-    s = "" if value is None else str(value)
-    f = filt.lower()
-    if f == "upper":   return s.upper()
-    if f == "lower":   return s.lower()
-    if f == "title":   return s.title()
-    if f == "trim":    return s.strip()
-    if f == "default": return s if s != "" else (arg or "")
-    return s
-
-def _parse_pipeline(inner: str) -> tuple[str, list[tuple[str, Optional[str]]]]:
-    parts: list[str] = []
-    buf: list[str] = []
-    in_quotes = False
-    escape = False
-    for ch in inner:
-        if escape:
-            buf.append(ch); escape = False; continue
-        if ch == '\\':
-            buf.append(ch); escape = True; continue
-        if ch == '"':
-            buf.append(ch); in_quotes = not in_quotes; continue
-        if ch == '|' and not in_quotes:
-            parts.append(''.join(buf).strip()); buf = []; continue
-        buf.append(ch)
-    if buf: parts.append(''.join(buf).strip())
-    if not parts: return "", []
-    var = parts[0].strip()
-    filters: list[tuple[str, Optional[str]]] = []
-    for seg in parts[1:]:
-        m = re.match(r'^([a-zA-Z_]\w*)(?:\s*:\s*"((?:\\.|[^"])*)")?\s*$', seg)
-        if not m: continue
-        fname = m.group(1)
-        farg  = _unescape_filter_arg(m.group(2)) if m.group(2) is not None else None
-        filters.append((fname, farg))
-    return var, filters
-
-def _interpolate(s: str, ctx: Dict[str, str]) -> str:
-    def repl(m: re.Match[str]) -> str:
-        inner = m.group(1)
-        var, filters = _parse_pipeline(inner)
-        val: Any = ctx.get(var, "")
-        for fname, farg in filters:
-            val = _apply_filter(val, fname, farg)
-        return "" if val is None else str(val)
-    return _VAR_TAG_RE.sub(repl, s)
+def _eval_expr(expr: str, ctx: Dict[str, str]) -> Any:
+    return run_code(compile_value(expr), ctx)
+
+# 旧式 if_goto 兼容（数字转换与新式比较共用同一份缓存）
+def _compare(a: str, op: str, b: str) -> bool:
+    fn = _CMP_FUNCS.get(op)
+    if fn is None:
+        raise ValueError(f"不支持的操作符：{op}")
+    na, nb = _to_number_maybe(a), _to_number_maybe(b)
+    if na is not None and nb is not None:
+        return fn(na, nb)
+    return fn(a, b)
 
 # =========================
-# 表达式求值（严格白名单）
+# 动作处理器：(engine, action, buffer) -> 跳转目标 State 或 None，按 opcode 查表调用
 # =========================
 
-_ALLOWED_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod)
-_ALLOWED_UNARY  = (ast.UAdd, ast.USub)
-
-def _fn_len(x):    return len(str(x))
-def _fn_abs(x):    return abs(float(x))
-def _fn_int(x):    return int(float(x))
-def _fn_float(x):  return float(x)
-def _fn_str(x):    return str(x)
-def _fn_upper(x):  return str(x).upper()
-def _fn_lower(x):  return str(x).lower()
-def _fn_title(x):  return str(x).title()
-def _fn_trim(x):   return str(x).strip()
-def _fn_min(a, b): return min(float(a), float(b))
-def _fn_max(a, b): return max(float(a), float(b))
-# ⭐ 新增：子串包含
-def _fn_contains(h, n): return str(n) in str(h)
-
-_FUNC_WHITELIST = {
-    "len": _fn_len, "abs": _fn_abs,
-    "int": _fn_int, "float": _fn_float, "str": _fn_str,
-    "upper": _fn_upper, "lower": _fn_lower, "title": _fn_title, "trim": _fn_trim,
-    "min": _fn_min, "max": _fn_max,
-    "contains": _fn_contains,
-}
+def _op_reply(eng: "Engine", act: ReplyAction, buffer: List[str]) -> Optional[State]:
+    buffer.append(render(act.segments, eng.ctx))
+    return None
 
-def _coerce_number(v: Any) -> Any:
-    if isinstance(v, (int, float)):
-        return float(v)
-    s = str(v)
-    try:
-        return float(s)
-    except Exception:
-        return v
-
-def _eval_value_node(node: ast.AST, ctx: Dict[str, str]) -> Any:
-    if isinstance(node, ast.Expression):
-        return _eval_value_node(node.body, ctx)
-
-    if isinstance(node, ast.BinOp) and isinstance(node.op, _ALLOWED_BINOPS):
-        l = _eval_value_node(node.left, ctx)
-        r = _eval_value_node(node.right, ctx)
-        ln, rn = _coerce_number(l), _coerce_number(r)
-        if isinstance(ln, (int, float)) and isinstance(rn, (int, float)):
-            if   isinstance(node.op, ast.Add):      return ln + rn
-            elif isinstance(node.op, ast.Sub):      return ln - rn
-            elif isinstance(node.op, ast.Mult):     return ln * rn
-            elif isinstance(node.op, ast.Div):      return ln / rn
-            elif isinstance(node.op, ast.FloorDiv): return ln // rn
-            elif isinstance(node.op, ast.Mod):      return ln % rn
-        if isinstance(node.op, ast.Add) and isinstance(l, str) and isinstance(r, str):
-            return l + r
-        raise ValueError("仅支持数字算术或字符串相加")
-
-    if isinstance(node, ast.UnaryOp) and isinstance(node.op, _ALLOWED_UNARY):
-        v = _eval_value_node(node.operand, ctx)
-        vn = _coerce_number(v)
-        if isinstance(vn, (int, float)):
-            return +vn if isinstance(node.op, ast.UAdd) else -vn
-        raise ValueError("一元正负仅支持数字")
-
-    if isinstance(node, ast.Name):
-        name = node.id
-        low = name.lower()
-        if low == "true":  return True
-        if low == "false": return False
-        if low == "null":  return None
-        return ctx.get(name, "")
-
-    if isinstance(node, ast.Constant):
-        return node.value
-
-    if isinstance(node, ast.Call):
-        if isinstance(node.func, ast.Name) and node.func.id in _FUNC_WHITELIST:
-            fn = _FUNC_WHITELIST[node.func.id]
-            args = [_eval_value_node(a, ctx) for a in node.args]
-            return fn(*args)
-        raise ValueError("仅允许白名单函数调用")
-
-    if isinstance(node, ast.Subscript) or isinstance(node, ast.Attribute):
-        raise ValueError("不允许下标/属性访问")
-
-    raise ValueError(f"表达式不被允许：{ast.dump(node, include_attributes=False)}")
+def _op_reply_text(eng: "Engine", act: ReplyAction, buffer: List[str]) -> Optional[State]:
+    buffer.append(act.text)   # 不含 {{...}} 的 reply：原文即输出
+    return None
 
-def _eval_expr(expr: str, ctx: Dict[str, str]) -> Any:
-    return _eval_value_node(ast.parse(expr, mode="eval"), ctx)
+def _op_goto(eng: "Engine", act: GotoAction, buffer: List[str]) -> Optional[State]:
+    return act.target_state
 
-# =========================
-# 比较与布尔表达式
-# =========================
+def _op_ask(eng: "Engine", act: AskAction, buffer: List[str]) -> Optional[State]:
+    # 在提示之前，把已有 reply 立刻输出，保证显示顺序正确
+    if buffer:
+        for line in buffer:
+            eng.printer(line)
+        buffer.clear()
 
-def _to_number_maybe(v: Any) -> Optional[float]:
-    if isinstance(v, (int, float)):
-        return float(v)
-    try:
-        return float(str(v))
-    except Exception:
-        return None
+    # 等待输入前先落盘：阻塞期间外部看到的是最新数据，中途被打断也不丢
+    if eng._dirty:
+        eng.flush()
+
+    var, prompt = act.var, act.prompt
 
-def _as_numbers(a: Any, b: Any) -> Optional[Tuple[float, float]]:
-    fa = _to_number_maybe(a)
-    fb = _to_number_maybe(b)
-    if fa is not None and fb is not None:
-        return (fa, fb)
+    # ✅ 关键改动：总是重新询问并覆盖旧值（不再依赖是否为空/是否存在）
+    eng.ctx[var] = eng.ask_fn(var, prompt) if eng.ask_fn else input(prompt)
+
+    eng._last_asked_var = var  # 记录最近一次问到的变量，供 LLM 兜底参考
+    return None
+
+def _op_set(eng: "Engine", act: SetAction, buffer: List[str]) -> Optional[State]:
+    eng.ctx[act.var] = act.value
+    return None
+
+def _op_set_expr(eng: "Engine", act: SetExprAction, buffer: List[str]) -> Optional[State]:
+    val = run_code(act.code, eng.ctx)
+    eng.ctx[act.var] = "" if val is None else str(val)
+    return None
+
+def _op_if_goto(eng: "Engine", act: IfGotoAction, buffer: List[str]) -> Optional[State]:
+    left = eng.ctx.get(act.left, "")
+    if left.__class__ is not str:
+        left = str(left)
+    # act.right 解析期就是字符串；其数字形式由 _to_number_maybe 的缓存复用
+    if _compare(left, "==", act.right):
+        return act.target_state
+    return None
+
+_NO_ACTIONS: Tuple[Action, ...] = ()   # 没有 else 时共用，不必每次新建空列表
+
+def _op_if_chain(eng: "Engine", act: IfChainAction, buffer: List[str]) -> Optional[State]:
+    # if_chain 由 lower_flow 展开为 Branch/Jump，状态函数里则直接生成 if/elif/else，
+    # 不会走到这里；仅可能出现在手工构造的旧版 if_block 分支体内
+    raise RuntimeError("if_chain 未经 lower_flow 展开，不能直接执行")
+
+def _op_if_block(eng: "Engine", act: IfBlockAction, buffer: List[str]) -> Optional[State]:  # 兼容旧版
+    left_val  = _eval_expr(act.left,  eng.ctx)
+    right_val = _eval_expr(act.right, eng.ctx)
+    branch = act.then if _do_compare(left_val, act.op, right_val) else (act.else_ or _NO_ACTIONS)
+    return eng._exec_actions(branch, buffer)
+
+def _op_save(eng: "Engine", act: SaveAction, buffer: List[str]) -> Optional[State]:
+    # 只改内存中的文档并记为脏，run_iter 结束时统一写回；
+    # 路径与文档都已缓存时（循环里反复 save 的常见情况）不走方法调用
+    key = eng._abs_paths.get(act.path) or eng._json_key(act.path)
+    doc = eng._json_docs.get(key)
+    if doc is None:
+        doc = eng._json_doc(key)
+    if doc is _BROKEN:
+        return None   # 不用空对象覆盖解析失败的文件（_json_doc 已给出提示）
+    doc[act.var] = str(eng.ctx.get(act.var, ""))
+    eng._dirty.add(key)
     return None
 
-def _do_compare(a: Any, op: str, b: Any) -> bool:
-    nums = _as_numbers(a, b)
-    if nums is not None:
-        a_num, b_num = nums
-        if     op == "==": return a_num == b_num
-        elif   op == "!=": return a_num != b_num
-        elif   op ==  ">": return a_num >  b_num
-        elif   op ==  "<": return a_num <  b_num
-        elif   op == ">=": return a_num >= b_num
-        elif   op == "<=": return a_num <= b_num
-    else:
-        a_str, b_str = str(a), str(b)
-        if     op == "==": return a_str == b_str
-        elif   op == "!=": return a_str != b_str
-        elif   op ==  ">": return a_str >  b_str
-        elif   op ==  "<": return a_str <  b_str
-        elif   op == ">=": return a_str >= b_str
-        elif   op == "<=": return a_str <= b_str
-    raise ValueError(f"不支持的操作符：{op}")
-
-# 旧式 if_goto 兼容
-def _to_number(s: str) -> Optional[float]:
+def _stream_value(path: str, var: str) -> Tuple[bool, Any]:
+    """大文件里只流式取顶层键 var 的值，返回 (是否已处理, 值)。
+    文件不大、不存在或流式解析出错（如 ijson 的 C 后端不接受 NaN、超出 64 位的整数）时
+    返回 (False, None)，由调用方整体读取；完整读到文档末尾仍没有该键时值为 _MISSING。
+    键重复时与整体解析一致，取最后一次出现的值，因此总要读到文档末尾。"""
     try:
-        return float(s)
+        if os.path.getsize(path) <= _STREAM_THRESHOLD:
+            return False, None
+        val = _MISSING
+        with open(path, "rb") as f:
+            for k, v in ijson.kvitems(f, "", use_float=True):
+                if k == var:
+                    val = v
+        return True, val
     except Exception:
-        return None
+        return False, None
+
+def _op_load(eng: "Engine", act: LoadAction, buffer: List[str]) -> Optional[State]:
+    key = eng._json_key(act.path)
+    if ijson is not None and key not in eng._json_docs:
+        streamed, val = _stream_value(key, act.var)
+        if streamed:
+            if val is not _MISSING:
+                eng.ctx[act.var] = str(val)
+            return None
+    data = eng._json_doc(key)
+    if isinstance(data, dict) and act.var in data:
+        eng.ctx[act.var] = str(data[act.var])
+    return None
 
-def _compare(a: str, op: str, b: str) -> bool:
-    na, nb = _to_number(a), _to_number(b)
-    if na is not None and nb is not None:
-        if   op == "==": return na == nb
-        elif op == "!=": return na != nb
-        elif op ==  ">": return na >  nb
-        elif op ==  "<": return na <  nb
-        elif op == ">=": return na >= nb
-        elif op == "<=": return na <= nb
-    else:
-        if   op == "==": return a == b
-        elif op == "!=": return a != b
-        elif op ==  ">": return a >  b
-        elif op ==  "<": return a <  b
-        elif op == ">=": return a >= b
-        elif op == "<=": return a <= b
-    raise ValueError(f"不支持的操作符：{op}")
-
-def _eval_bool(expr: str, ctx: Dict[str, str]) -> bool:
-    tree = ast.parse(expr, mode="eval")
-
-    def ev(node: ast.AST) -> bool:
-        if isinstance(node, ast.Expression):
-            return ev(node.body)
-
-        if isinstance(node, ast.BoolOp):
-            if isinstance(node.op, ast.And):
-                for v in node.values:
-                    if not ev(v): return False
-                return True
-            if isinstance(node.op, ast.Or):
-                for v in node.values:
-                    if ev(v): return True
-                return False
-            raise ValueError("仅支持 and / or")
-
-        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
-            return not ev(node.operand)
-
-        if isinstance(node, ast.Compare):
-            left_val = _eval_value_node(node.left, ctx)
-            cur = left_val
-            for op, comp in zip(node.ops, node.comparators):
-                right_val = _eval_value_node(comp, ctx)
-                if   isinstance(op, ast.Eq):    ok = _do_compare(cur, "==", right_val)
-                elif isinstance(op, ast.NotEq): ok = _do_compare(cur, "!=", right_val)
-                elif isinstance(op, ast.Gt):    ok = _do_compare(cur, ">",  right_val)
-                elif isinstance(op, ast.Lt):    ok = _do_compare(cur, "<",  right_val)
-                elif isinstance(op, ast.GtE):   ok = _do_compare(cur, ">=", right_val)
-                elif isinstance(op, ast.LtE):   ok = _do_compare(cur, "<=", right_val)
-                else:
-                    raise ValueError("比较运算仅支持 == != > < >= <=")
-                if not ok: return False
-                cur = right_val
-            return True
+# EndAction 的返回值：状态正常走到末尾、没有跳转
+_NO_JUMP = object()
+
+def _op_end(eng: "Engine", act: EndAction, buffer: List[str]) -> Any:
+    return _NO_JUMP
 
-        if isinstance(node, (ast.Constant, ast.Name, ast.BinOp, ast.UnaryOp, ast.Call)):
-            v = _eval_value_node(node, ctx)
-            if isinstance(v, (int, float)): return v != 0
-            return bool(v)
+# Branch/Jump 只出现在 Flow.code 中，返回 int 表示下一条指令的位置
+def _op_branch(eng: "Engine", act: BranchAction, buffer: List[str]) -> Optional[int]:
+    return None if run_code(act.code, eng.ctx) else act.else_pc
 
-        raise ValueError(f"不允许的布尔表达式：{ast.dump(node, include_attributes=False)}")
+def _op_jump(eng: "Engine", act: JumpAction, buffer: List[str]) -> int:
+    return act.target_pc
 
-    return ev(tree)
+_OP_HANDLERS: Dict[type, Callable[["Engine", Any, List[str]], Optional[State]]] = {
+    ReplyAction: _op_reply, GotoAction: _op_goto, AskAction: _op_ask,
+    SetAction: _op_set, SetExprAction: _op_set_expr, IfGotoAction: _op_if_goto,
+    IfChainAction: _op_if_chain, IfBlockAction: _op_if_block,
+    SaveAction: _op_save, LoadAction: _op_load, EndAction: _op_end,
+    BranchAction: _op_branch, JumpAction: _op_jump,
+}
+# 下标即 opcode
+_OPS = tuple(_OP_HANDLERS[cls] for cls in ACTION_TYPES)
+
+# =========================
+# 状态函数：把每个状态的动作生成一段直线 Python 代码（if/elif/else 原样写成分支），
+# reply/set/goto 直接内联，其余动作调用对应处理函数；生成失败的状态仍在 Flow.code 上逐条解释
+# =========================
+
+def _bind(env: Dict[str, Any], obj: Any) -> str:
+    name = f"_k{len(env)}"
+    env[name] = obj
+    return name
+
+def _fstring_literal(text: str) -> str:
+    """转义为双引号 f-string 里的字面部分。"""
+    return (text.encode("unicode_escape").decode("ascii")
+            .replace('"', '\\"').replace("{", "{{").replace("}", "}}"))
+
+def _gen_fstring(segs: Tuple[Any, ...], env: Dict[str, Any]) -> Optional[str]:
+    """不带过滤器的模板直接写成 f-string，由 CPython 的格式化在 C 里拼接；
+    值的处理与 render 相同（None 为空串，其余按 str 输出）。带过滤器的返回 None。"""
+    parts = []
+    for seg in segs:
+        if seg.__class__ is str:
+            parts.append(_fstring_literal(seg))
+            continue
+        var, filters = seg
+        if filters:
+            return None
+        name = repr(var) if var.isidentifier() else _bind(env, var)
+        parts.append(f"{{'' if (v := get({name}, '')) is None else v}}")
+    return 'f"' + "".join(parts) + '"'
+
+def _gen_actions(actions: List[Action], lines: List[str], depth: int, env: Dict[str, Any]) -> None:
+    pad = "    " * depth
+    start = len(lines)
+    for act in actions:
+        cls = act.__class__
+        if cls is ReplyAction:
+            if all(seg.__class__ is str for seg in act.segments):
+                lines.append(f"{pad}append({act.text!r})")
+            else:
+                fs = _gen_fstring(act.segments, env)
+                if fs is None:
+                    fs = f"_render({_bind(env, act.segments)}, ctx)"
+                lines.append(f"{pad}append({fs})")
+        elif cls is SetAction:
+            lines.append(f"{pad}ctx[{act.var!r}] = {act.value!r}")
+        elif cls is SetExprAction:
+            lines.append(f"{pad}v = {_bind(env, as_function(act.code))}(ctx)")
+            lines.append(f"{pad}ctx[{act.var!r}] = '' if v is None else str(v)")
+        elif cls is GotoAction:
+            if act.target_state is not None:   # 未解析的 goto 与 _op_goto 一致：不跳转
+                lines.append(f"{pad}return {_bind(env, act.target_state)}")
+        elif cls is IfGotoAction:
+            # 右侧是常量：数字形式在生成时算好；右侧不是数字时只可能按字符串比较
+            if act.target_state is not None:
+                lines.append(f"{pad}w = get({act.left!r}, '')")
+                lines.append(f"{pad}if w.__class__ is not str: w = str(w)")
+                right_num = _to_number_maybe(act.right)
+                if right_num is None:
+                    cond = f"w == {act.right!r}"
+                else:
+                    lines.append(f"{pad}n = _num(w)")
+                    cond = f"(w == {act.right!r} if n is None else n == {_bind(env, right_num)})"
+                lines.append(f"{pad}if {cond}: return {_bind(env, act.target_state)}")
+        elif cls is IfChainAction:
+            kw = "if"
+            for br in act.branches:
+                lines.append(f"{pad}{kw} {_bind(env, as_function(br.code))}(ctx):")
+                _gen_actions(br.actions, lines, depth + 1, env)
+                kw = "elif"
+            if act.else_:
+                if act.branches:
+                    lines.append(f"{pad}else:")
+                    _gen_actions(act.else_, lines, depth + 1, env)
+                else:
+                    _gen_actions(act.else_, lines, depth, env)
+        else:
+            lines.append(f"{pad}r = {_bind(env, _OPS[act.opcode])}(eng, {_bind(env, act)}, buffer)")
+            lines.append(f"{pad}if r is not None: return r")
+    if len(lines) == start:
+        lines.append(f"{pad}pass")
+
+def _compile_state(state: State) -> Optional[Callable[["Engine", List[str]], Any]]:
+    """生成 fn(engine, buffer)，返回值与 Flow.code 上执行到 EndAction 时相同。"""
+    env: Dict[str, Any] = {"_render": render, "_NO_JUMP": _NO_JUMP, "_num": _to_number_maybe}
+    lines = ["def _state(eng, buffer):", "    ctx = eng.ctx", "    get = ctx.get",
+             "    append = buffer.append"]
+    try:
+        _gen_actions(state.actions, lines, 1, env)
+        lines.append("    return _NO_JUMP")
+        exec(compile("\n".join(lines), f"<state {state.name}>", "exec"), env)
+    except Exception:   # 嵌套过深等：退回逐条解释
+        return None
+    return env["_state"]
+
+def _handler_for(act: Action) -> Callable:
+    """Flow.handlers 的填充规则：按 opcode 取处理函数，纯文本 reply 换成免渲染版本。"""
+    if act.__class__ is ReplyAction and all(seg.__class__ is str for seg in act.segments):
+        return _op_reply_text
+    return _OPS[act.opcode]
 
 # =========================
 # 引擎
@@ -277,14 +285,24 @@ class Engine:
     def __init__(self, program: Program, flow_name: str = "main",
                  context: Optional[Dict[str, str]] = None,
                  ask_fn=None, debug: bool = False, use_llm: bool = False,
-                 printer: Optional[Callable[[str], None]] = None):
+                 printer: Optional[Callable[[str], None]] = None,
+                 own_context: bool = False):
+        """own_context=True：直接把 context 作为 self.ctx 使用（不复制），
+        调用方把该 dict 的所有权交给引擎，运行中的修改会反映到原对象上。"""
         if flow_name not in program.flows:
             raise KeyError(f"找不到 flow: {flow_name}")
         self.flow: Flow = program.flows[flow_name]
         if not self.flow.states:
             raise ValueError("该 flow 下没有任何 state")
+        if not self.flow.code:
+            lower_flow(self.flow)   # 手工构造、未经 parse 的 Flow
+        if len(self.flow.handlers) != len(self.flow.code):
+            self.flow.handlers = tuple(_handler_for(act) for act in self.flow.code)
+        if not self.flow.funcs:
+            self.flow.funcs = {name: _compile_state(st) for name, st in self.flow.states.items()}
         self.state_name = next(iter(self.flow.states.keys()))
-        self.ctx: Dict[str, str] = dict(context or {})
+        self.ctx: Dict[str, str] = (context if own_context and context is not None
+                                    else dict(context or {}))
         self.ask_fn = ask_fn
         self.debug = debug
         self.use_llm = use_llm
@@ -292,149 +310,136 @@ class Engine:
 
         self.llm_client = DeepSeekClient() if (use_llm and DeepSeekClient is not None) else None
         self._last_asked_var: Optional[str] = None
-        self._visits: Dict[str, int] = {}
+        self._visits: Dict[str, int] = defaultdict(int)   # 状态名 -> 进入次数（按引擎计）
+        # save/load 的 JSON 文档缓存（绝对路径 -> 已解析内容），仅在一次 run_iter 内有效
+        self._json_docs: Dict[str, Any] = {}
+        self._dirty: Set[str] = set()
+        self._abs_paths: Dict[str, str] = {}   # 脚本里的路径 -> 绝对路径，引擎生命周期内只算一次
+        self._mkdir_done: Set[str] = set()     # 已确认父目录存在的文件
         self.fallback_state: Optional[str] = None
         for name in ("fallback", "unknown", "end"):
             if name in self.flow.states:
                 self.fallback_state = name
                 break
 
-    def _exec_actions(self, actions: List[Action], buffer: List[str]) -> Optional[str]:
+    def _exec_actions(self, actions: List[Action], buffer: List[str]) -> Optional[State]:
         """
         actions：当前状态内的动作
         buffer：reply 输出缓冲；遇到 ask 时立刻 flush 到终端
+        返回跳转目标 State（解析期已解析好；无跳转为 None）
         """
+        ops = _OPS
         for act in actions:
-            k = act.kind
-            a = act.args
-
-            if k == "reply":
-                buffer.append(_interpolate(a["text"], self.ctx))
-
-            elif k == "set":
-                self.ctx[a["var"]] = a["value"]
-
-            elif k == "set_expr":
-                val = _eval_expr(a["expr"], self.ctx)
-                self.ctx[a["var"]] = "" if val is None else str(val)
-
-            elif k == "ask":
-                # 在提示之前，把已有 reply 立刻输出，保证显示顺序正确
-                if buffer:
-                    for line in buffer:
-                        self.printer(line)
-                    buffer.clear()
-
-                var, prompt = a["var"], a["prompt"]
-
-                # ✅ 关键改动：总是重新询问并覆盖旧值（不再依赖是否为空/是否存在）
-                self.ctx[var] = self.ask_fn(var, prompt) if self.ask_fn else input(prompt)
-
-                self._last_asked_var = var  # 记录最近一次问到的变量，供 LLM 兜底参考
-
-
-
-            elif k == "if_goto":
-                left = self.ctx.get(a["left"], "")
-                if _compare(str(left), "==", str(a["right"])):
-                    return a["target"]
-
-            elif k == "if_chain":
-                fired = False
-                for br in a["branches"]:
-                    if _eval_bool(br["cond"], self.ctx):
-                        ret = self._exec_actions(br["actions"], buffer)
-                        if ret is not None:
-                            return ret
-                        fired = True
-                        break
-                if not fired and a.get("else"):
-                    ret = self._exec_actions(a["else"], buffer)
-                    if ret is not None:
-                        return ret
-
-            elif k == "if_block":  # 兼容旧版
-                left_val  = _eval_expr(a["left"],  self.ctx)
-                right_val = _eval_expr(a["right"], self.ctx)
-                branch: List[Action] = a["then"] if _do_compare(left_val, a["op"], right_val) else (a.get("else") or [])
-                ret = self._exec_actions(branch, buffer)
-                if ret is not None:
-                    return ret
-
-            elif k == "goto":
-                return a["target"]
-
-            elif k == "save":
-                p = Path(a["path"])
-                p.parent.mkdir(parents=True, exist_ok=True)
-                data: Dict[str, Any] = {}
-                if p.exists():
-                    try:
-                        data = json.loads(p.read_text(encoding="utf-8") or "{}")
-                    except Exception:
-                        data = {}
-                data[a["var"]] = str(self.ctx.get(a["var"], ""))
-                p.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-
-            elif k == "load":
-                p = Path(a["path"])
-                if p.exists():
-                    try:
-                        data = json.loads(p.read_text(encoding="utf-8"))
-                        if isinstance(data, dict) and a["var"] in data:
-                            self.ctx[a["var"]] = str(data[a["var"]])
-                    except Exception:
-                        pass
-
-            else:
-                raise ValueError(f"未知动作：{k}")
+            ret = ops[act.opcode](self, act, buffer)
+            if ret is not None:
+                return ret
         return None
 
+    def _json_key(self, path: str) -> str:
+        key = self._abs_paths.get(path)
+        if key is None:
+            key = self._abs_paths[path] = os.path.abspath(path)
+        return key
+
+    def _json_doc(self, key: str) -> Any:
+        """取 save/load 目标文件的已解析内容：每个文件只读一次；不存在视为空对象，
+        存在但解析失败时返回 _BROKEN（load 忽略它，save 跳过它，文件保持原样）。"""
+        data = self._json_docs.get(key)
+        if data is None:
+            data = {}
+            if os.path.exists(key):
+                try:
+                    with open(key, "rb") as f:
+                        data = loads(f.read() or b"{}")
+                except Exception:
+                    data = _BROKEN
+                    print(f"[Engine] ⚠ {key} 不是有效的 JSON，本次运行不会写入该文件",
+                          file=sys.stderr)
+            self._json_docs[key] = data
+        return data
+
+    def flush(self) -> None:
+        """把被 save 改动过的文件写回磁盘，并清空缓存（下次运行重新读取，看到外部修改）。"""
+        for key in self._dirty:
+            if key not in self._mkdir_done:
+                os.makedirs(os.path.dirname(key), exist_ok=True)
+                self._mkdir_done.add(key)
+            dump_file(key, self._json_docs[key])
+        self._dirty.clear()
+        self._json_docs.clear()
+
     def run_iter(self) -> Iterable[str]:
         """
         流式执行当前 flow：
         - reply 先写入缓冲，遇到 ask 会先 flush 再弹出提示
         - 状态末尾若没有跳转：如果有最近问到的变量，才用 LLM 进行兜底路由
+        - save 的写入先留在内存里，遇到 ask 或结束时（含因异常中断）一次性落盘
         """
-        guard = 0
-        while True:
-            guard += 1
-            if guard > 2000:
-                raise RuntimeError("可能出现死循环")
+        try:
+            guard = 0
+            # 循环内不变的对象绑定到局部变量；buffer 整个运行期复用一个列表
+            states, visits = self.flow.states, self._visits
+            code, handlers, funcs = self.flow.code, self.flow.handlers, self.flow.funcs
+            llm = self.llm_client if self.use_llm else None
+            fallback = states[self.fallback_state] if self.fallback_state else None
+            buffer: List[str] = []
+            state = states[self.state_name]
+            while True:
+                guard += 1
+                if guard > 2000:
+                    raise RuntimeError("可能出现死循环")
+
+                name = state.name
+                visits[name] += 1
+                self._last_asked_var = None  # 进入新状态，重置
+
+                run = funcs.get(name)
+                if run is not None:
+                    target = run(self, buffer)
+                else:
+                    # 没有生成的状态函数：在 flow 的扁平指令序列上从本状态起点顺序执行，
+                    # 直到跳转或 EndAction
+                    pc = state.offset
+                    while True:
+                        target = handlers[pc](self, code[pc], buffer)
+                        pc += 1
+                        if target is not None:
+                            if target.__class__ is int:
+                                pc = target
+                                continue
+                            break
+                if target is _NO_JUMP:
+                    target = None
+
+                # 把状态内剩余的输出统一吐出（若中间没有 ask，这里会一次性输出）
+                if buffer:
+                    yield from buffer
+                    buffer.clear()
 
-            self._visits[self.state_name] = self._visits.get(self.state_name, 0) + 1
-            self._last_asked_var = None  # 进入新状态，重置
+                if target is None:
+                    asked = self._last_asked_var
+                    # ✅ 若本轮没有 ask 且也没有显式跳转：视为终止（比如 end 状态）
+                    if asked is None:
+                        break
 
-            state = self.flow.states[self.state_name]
-            buffer: List[str] = []
-            target = self._exec_actions(state.actions, buffer)
+                    # 先尝试 LLM 兜底（仅当本轮确实 ask 过）
+                    if llm and asked:
+                        suggestion = llm.classify_intent(
+                            self.ctx.get(asked, ""), list(states.keys()), exclude=[name],
+                        )
+                        if suggestion and suggestion in states and suggestion != name:
+                            yield f"(LLM判定意图：{suggestion})"
+                            target = states[suggestion]
 
-            # 把状态内剩余的输出统一吐出（若中间没有 ask，这里会一次性输出）
-            for line in buffer:
-                yield line
+                    # 仍未跳转：存在 fallback 则立即兜底过去
+                    if target is None:
+                        target = fallback
 
-            # ✅ 若本轮没有 ask 且也没有显式跳转：视为终止（比如 end 状态）
-            if target is None and self._last_asked_var is None:
-                break
+                if target is not None:
+                    state = target
+                    self.state_name = state.name
+                    continue
 
-            # 若还没有跳转 → 先尝试 LLM 兜底（仅当本轮确实 ask 过）
-            if target is None and self.use_llm and self.llm_client and self._last_asked_var:
-                user_text = self.ctx.get(self._last_asked_var, "")
-                suggestion = self.llm_client.classify_intent(
-                    user_text, list(self.flow.states.keys()), exclude=[self.state_name],
-                )
-                if suggestion and suggestion in self.flow.states and suggestion != self.state_name:
-                    yield f"(LLM判定意图：{suggestion})"
-                    target = suggestion
-
-            # 仍未跳转：若本轮 ask 过且存在 fallback，则立即兜底过去
-            if target is None and self._last_asked_var is not None and self.fallback_state:
-                target = self.fallback_state
-
-            if target is not None:
-                if target not in self.flow.states:
-                    raise KeyError(f"goto 的目标状态不存在：{target}")
-                self.state_name = target
-                continue
-
-            break
+                break
+        finally:
+            self.flush()
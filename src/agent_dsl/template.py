@@ -0,0 +1,105 @@
+# src/agent_dsl/template.py
+import re
+import sys
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+# =========================
+# 字符串插值（支持过滤器管道）
+# 解析期把模板拆成“字面量 / 变量+过滤器”片段，运行期只做拼接
+# =========================
+
+_VAR_TAG_RE = re.compile(r"\{\{\s*(.*?)\s*\}\}")
+_FILTER_RE = re.compile(r'^([a-zA-Z_]\w*)(?:\s*:\s*"((?:\\.|[^"])*)")?\s*$')
+
+def _unescape_filter_arg(text: str) -> str:
+    return text.replace(r'\"', '"').replace(r'\\', '\\')
+
+def _split_quoted(inner: str) -> list[str]:
+    """按不在引号内的 | 切分，反斜杠转义下一个字符。"""
+    parts: list[str] = []
+    buf: list[str] = []
+    in_quotes = False
+    escape = False
+    for ch in inner:
+        if escape:
+            buf.append(ch); escape = False; continue
+        if ch == '\\':
+            buf.append(ch); escape = True; continue
+        if ch == '"':
+            buf.append(ch); in_quotes = not in_quotes; continue
+        if ch == '|' and not in_quotes:
+            parts.append(''.join(buf).strip()); buf = []; continue
+        buf.append(ch)
+    if buf: parts.append(''.join(buf).strip())
+    return parts
+
+def _parse_pipeline(inner: str) -> tuple[str, list[tuple[str, Optional[str]]]]:
+    if '"' not in inner and '\\' not in inner:
+        # 没有引号/转义时 | 只能是分隔符：直接 split（结果与逐字符扫描一致）
+        parts = [p.strip() for p in inner.split('|')]
+    else:
+        parts = _split_quoted(inner)
+    if not parts: return "", []
+    var = parts[0].strip()
+    filters: list[tuple[str, Optional[str]]] = []
+    for seg in parts[1:]:
+        m = _FILTER_RE.match(seg)
+        if not m: continue
+        fname = m.group(1)
+        farg  = _unescape_filter_arg(m.group(2)) if m.group(2) is not None else None
+        filters.append((fname, farg))
+    return var, filters
+
+# 过滤器：(字符串值, 参数) -> str；渲染时先把值统一转成 str 再依次调用，
+# 过滤器本身不再做类型判断。模块级函数，解析结果可以直接 pickle
+def _f_upper(s: str, arg: Optional[str]) -> str:   return s.upper()
+def _f_lower(s: str, arg: Optional[str]) -> str:   return s.lower()
+def _f_title(s: str, arg: Optional[str]) -> str:   return s.title()
+def _f_trim(s: str, arg: Optional[str]) -> str:    return s.strip()
+def _f_default(s: str, arg: Optional[str]) -> str: return s if s != "" else (arg or "")
+def _f_unknown(s: str, arg: Optional[str]) -> str: return s   # 未知过滤器：原样输出
+
+_FILTERS: Dict[str, Callable[[str, Optional[str]], str]] = {
+    "upper": _f_upper, "lower": _f_lower, "title": _f_title,
+    "trim": _f_trim, "default": _f_default,
+}
+
+Filter = Tuple[Callable[[str, Optional[str]], str], Optional[str]]
+# 片段：str 为字面量；(变量名, ((过滤器, 参数), ...)) 为插值
+Segment = Union[str, Tuple[str, Tuple[Filter, ...]]]
+
+def compile_template(s: str) -> Tuple[Segment, ...]:
+    """把模板一次性拆成片段；过滤器名（不区分大小写）在这里解析为函数。"""
+    if "{{" not in s:
+        return (s,) if s else ()   # 纯文本：不必进正则
+    # split 的结果是 [字面量, 标签内容, 字面量, ..., 字面量]，奇数位为标签
+    parts = _VAR_TAG_RE.split(s)
+    segs: list[Segment] = []
+    for i, part in enumerate(parts):
+        if not i & 1:
+            if part:
+                segs.append(part)
+            continue
+        var, filters = _parse_pipeline(part)
+        # 变量名 intern，与解析器中的 set/ask 变量名为同一对象，ctx 查找可走指针比较
+        segs.append((sys.intern(var),
+                     tuple((_FILTERS.get(f.lower(), _f_unknown), a) for f, a in filters)))
+    return tuple(segs)
+
+def render(segs: Tuple[Segment, ...], ctx: Dict[str, Any]) -> str:
+    parts = []
+    get = ctx.get
+    for seg in segs:
+        if seg.__class__ is str:
+            parts.append(seg)
+            continue
+        var, filters = seg
+        val = get(var, "")   # 缺失变量渲染为空串：默认值是常量，不必按变量名构造
+        # 常见情况（值本来就是 str）不做任何转换
+        if val.__class__ is not str:
+            val = "" if val is None else str(val)
+        if filters:
+            for fn, arg in filters:
+                val = fn(val, arg)
+        parts.append(val)
+    return "".join(parts)
@@ -1,14 +1,24 @@
 from __future__ import annotations
-import uuid
+import asyncio
+import gzip
+import os
+import secrets
+import stat
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Optional, List, Callable
+from typing import Deque, Dict, Optional, List, Tuple
 
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse
 from jinja2 import Environment, FileSystemLoader, select_autoescape
+from pydantic import BaseModel
 
-from .parser import parse
+from .jsonio import orjson
+from .parser import Program, parse
 from .runtime import Engine
 
 # ========= 路径 =========
@@ -18,7 +28,8 @@ STATIC_DIR = ROOT_DIR / "static"
 
 env = Environment(
     loader=FileSystemLoader(str(TEMPLATES_DIR)),
-    autoescape=select_autoescape(["html", "xml"])
+    autoescape=select_autoescape(["html", "xml"]),
+    auto_reload=False,   # 模板只在进程启动后读取一次
 )
 
 # ========= 中断异常：用于在下一次 ask 前停下 =========
@@ -29,43 +40,111 @@ class NeedMoreInput(Exception):
         self.prompt = prompt
 
 # ========= FastAPI =========
-app = FastAPI(title="Agent-DSL Web UI")
+# 装了 orjson 就用 ORJSONResponse 序列化（聊天记录较长时编码明显更快），否则退回标准库
+ApiResponse = ORJSONResponse if orjson is not None else JSONResponse
+
+class CachedStaticFiles(StaticFiles):
+    """缓存请求路径到磁盘完整路径的解析结果（省去每次的 realpath 与目录逐个探测），
+    但每个请求仍重新 stat：文件改动后 Content-Length/ETag/Last-Modified 立即跟着变。
+    只缓存找到的普通文件；找不到的路径不缓存，新加的文件马上可以访问。"""
+    def __init__(self, *args, max_entries: int = 256, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._max_entries = max_entries
+        self._resolved: Dict[str, str] = {}
+
+    def lookup_path(self, path: str):
+        full_path = self._resolved.get(path)
+        if full_path is not None:
+            try:
+                st = os.stat(full_path)
+                if stat.S_ISREG(st.st_mode):
+                    return full_path, st
+            except OSError:
+                pass
+            # 文件已删除或被替换成目录：重新解析。lookup_path 在线程池里并发调用，
+            # 另一个请求可能已经删掉了这一项
+            self._resolved.pop(path, None)
+        full_path, st = super().lookup_path(path)
+        if st is not None and stat.S_ISREG(st.st_mode):
+            if len(self._resolved) >= self._max_entries:
+                self._resolved.clear()
+            self._resolved[path] = full_path
+        return full_path, st
+
+class GZipExceptMiddleware:
+    """GZipMiddleware，但跳过 skip_paths 中的路由。首页自己返回预压缩的内容；
+    较旧的 Starlette 不认已有的 Content-Encoding，会把它再压缩一遍。"""
+    def __init__(self, app, skip_paths: Tuple[str, ...] = (), **options):
+        self.app = app
+        self.gzip = GZipMiddleware(app, **options)
+        self.skip_paths = frozenset(skip_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+        else:
+            await self.gzip(scope, receive, send)
+
+app = FastAPI(title="Agent-DSL Web UI", default_response_class=ApiResponse)
+# 聊天记录接近上限时响应体可达数十 KB，结构重复、压缩率高；压缩级别取中等，省 CPU
+app.add_middleware(GZipExceptMiddleware, skip_paths=("/",), minimum_size=512, compresslevel=4)
 if STATIC_DIR.exists():
-    app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
+    app.mount("/static", CachedStaticFiles(directory=str(STATIC_DIR)), name="static")
 else:
     print(f"[WebApp] ⚠ static 目录不存在：{STATIC_DIR}")
 
 # ========= 会话 =========
+# 会话内存的粗略估计：固定开销（引擎、上下文等）+ 每条消息的文本长度与字典开销。
+# 经 _load_dsl 加载的脚本文本与解析结果由各会话共享（缓存本身有条数上限），不计入单个会话
+_SESSION_OVERHEAD = 4096
+_MESSAGE_OVERHEAD = 64
+CHAT_WINDOW = 200   # 每个会话只保留（并返回给前端）最近这么多条消息
+
 class SessionState:
-    def __init__(self, program_text: str, dsl_path: str, use_llm: bool):
+    # 属性集合固定：用 __slots__ 省掉每个会话的 __dict__，会话多时内存更省
+    __slots__ = ("nbytes", "program_text", "dsl_path", "use_llm", "program",
+                 "engine", "chat", "await_var", "await_prompt", "_msgs", "_pending", "lock",
+                 "_states")
+
+    def __init__(self, program_text: str, dsl_path: str, use_llm: bool,
+                 program: Optional[Program] = None):
+        # 估算的内存占用；只有自己解析的脚本才算在本会话头上
+        self.nbytes = _SESSION_OVERHEAD + (len(program_text) if program is None else 0)
         self.program_text = program_text
         self.dsl_path = dsl_path
         self.use_llm = use_llm
-        self.program = parse(program_text)
-        self.engine: Engine = self._create_engine([])
-        self.chat: List[Dict] = []           # {"role": "assistant"/"user", "text": "..."}
+        self.program = program if program is not None else parse(program_text)
+        self._msgs: Deque[str] = deque()   # 本轮引擎输出，每次 step() 清空复用
+        self._pending: List[str] = []      # 本轮尚未交给 ask 的用户输入
+        self.lock = asyncio.Lock()         # 同一会话的请求排队推进，互不覆盖输出与输入
+        self.engine: Engine = self._create_engine()
+        self._states = frozenset(self.engine.flow.states)   # 判断会话是否结束用；流程的状态集不会变
+        self.chat: Deque[Dict] = deque(maxlen=CHAT_WINDOW)   # {"role": "assistant"/"user", "text": "..."}
         self.await_var: Optional[str] = None
         self.await_prompt: Optional[str] = None
 
-    def _make_ask_fn(self, inputs: List[str]) -> Callable[[str, str], str]:
-        """第一次返回 inputs[0]；否则抛 NeedMoreInput 让前端提示下一步输入。"""
-        called = {"n": 0}
-        def ask(var: str, prompt: str) -> str:
-            called["n"] += 1
-            if called["n"] == 1 and inputs:
-                return inputs[0]
-            raise NeedMoreInput(var, prompt)
-        return ask
-
-    def _create_engine(self, inputs: List[str]) -> Engine:
+    def _append_chat(self, role: str, text: str) -> None:
+        if len(self.chat) == CHAT_WINDOW:   # 窗口已满：最旧的一条会被挤出
+            self.nbytes -= _MESSAGE_OVERHEAD + len(self.chat[0]["text"])
+        self.chat.append({"role": role, "text": text})
+        self.nbytes += _MESSAGE_OVERHEAD + len(text)
+
+    def _ask(self, var: str, prompt: str) -> str:
+        """本轮第一次 ask 取走用户输入；之后（或本轮没有输入时）抛 NeedMoreInput 让前端提示。"""
+        if self._pending:
+            return self._pending.pop()
+        raise NeedMoreInput(var, prompt)
+
+    def _create_engine(self) -> Engine:
+        # printer / ask_fn 都是绑定方法，只在这里设置一次，step() 不再重建闭包
         return Engine(
             program=self.program,
             flow_name="main",
             context=None,
-            ask_fn=self._make_ask_fn(inputs),
+            ask_fn=self._ask,
             debug=False,
             use_llm=self.use_llm,
-            printer=lambda s: None,   # 在 step() 里覆盖为收集函数
+            printer=self._msgs.append,   # 把 ask 前冲洗出来的 reply 收集到 _msgs
         )
 
     def step(self, user_text: Optional[str]) -> Dict:
@@ -74,18 +153,15 @@ class SessionState:
         - 若提供 user_text 则作为本轮第一个 ask 的回答
         - 返回 messages / await / ended
         """
-        msgs: List[str] = []
-
-        # 覆盖引擎的 printer：把 ask 前冲洗出来的 reply 收集到 msgs
-        self.engine.printer = lambda s: msgs.append(s)
+        msgs = self._msgs
+        msgs.clear()
 
-        # 记录用户发言
+        # 记录用户发言，并交给本轮第一个 ask
         if user_text is not None:
-            self.chat.append({"role": "user", "text": user_text})
-
-        # 更新 ask_fn
-        inputs = [user_text] if user_text is not None else []
-        self.engine.ask_fn = self._make_ask_fn(inputs)
+            self._append_chat("user", user_text)
+            self._pending = [user_text]
+        else:
+            self._pending = []
 
         try:
             for out in self.engine.run_iter():
@@ -106,53 +182,142 @@ class SessionState:
             and self.chat[-1]["role"] == "assistant"
             and msgs[0] == self.chat[-1]["text"]
         ):
-            msgs = msgs[1:]
+            msgs.popleft()
 
         # 写入新产生的助手消息
         for m in msgs:
-            self.chat.append({"role": "assistant", "text": m})
+            self._append_chat("assistant", m)
 
         return {
-            "messages": [{"role": m["role"], "text": m["text"]} for m in self.chat[-200:]],
+            "messages": list(self.chat),   # 消息字典只有 role/text 两个键，直接返回
             "await": None if self.await_var is None else {"var": self.await_var, "prompt": self.await_prompt},
-            "ended": self.await_var is None and not msgs and self.engine.state_name not in self.engine.flow.states,
+            "ended": self.await_var is None and not msgs and self.engine.state_name not in self._states,
         }
 
-# 全局会话表
-SESSIONS: Dict[str, SessionState] = {}
+# 全局会话表：按最近使用排序（LRU）；会话数或估算内存总量超过上限时，
+# 从最久未访问的会话开始淘汰（最近使用的那个总会保留）
+MAX_SESSIONS = 1024
+MAX_SESSION_BYTES = 64 * 1024 * 1024
+SESSIONS: "OrderedDict[str, SessionState]" = OrderedDict()
+_session_bytes = 0   # 所有会话 nbytes 之和
+
+def _evict() -> None:
+    global _session_bytes
+    while len(SESSIONS) > 1 and (len(SESSIONS) > MAX_SESSIONS
+                                 or _session_bytes > MAX_SESSION_BYTES):
+        _, old = SESSIONS.popitem(last=False)
+        _session_bytes -= old.nbytes
+
+def _add_session(sid: str, state: SessionState) -> None:
+    global _session_bytes
+    SESSIONS[sid] = state
+    _session_bytes += state.nbytes
+    _evict()
+
+# 所有会话的引擎都在同一个工作线程里逐个推进：save 对同一文件的读-改-写
+# （首次 save 读入整份文档，ask 或结束时整份写回）不会在会话之间交错，
+# 与原先在事件循环里逐个执行时一致，同时事件循环本身不被占住
+_ENGINE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="agent-dsl-engine")
+
+async def _step(sid: str, state: SessionState, user_text: Optional[str]) -> Dict:
+    """推进会话并更新内存统计；聊天记录增长后可能触发淘汰。
+    同一会话的并发请求在会话锁上排队，按到达顺序逐个推进；引擎在 _ENGINE_EXECUTOR
+    里运行。会话表与内存统计只在事件循环线程里修改。"""
+    global _session_bytes
+    async with state.lock:
+        before = state.nbytes
+        loop = asyncio.get_running_loop()
+        payload = await loop.run_in_executor(_ENGINE_EXECUTOR, state.step, user_text)
+        if SESSIONS.get(sid) is state:   # 推进期间可能已被淘汰，淘汰时已扣除其内存
+            _session_bytes += state.nbytes - before
+    _evict()
+    return payload
+
+def _get_session(sid: Optional[str]) -> Optional[SessionState]:
+    state = SESSIONS.get(sid) if sid else None
+    if state is not None:
+        SESSIONS.move_to_end(sid)
+    return state
+
+# ========= 脚本缓存 =========
+@lru_cache(maxsize=64)
+def _load_dsl(dsl_path: str, mtime_ns: int) -> Tuple[str, Program]:
+    """读取并解析脚本；以 (路径, 修改时间) 为键，同一版本的脚本只解析一次，
+    各会话共享同一个 Program（引擎不会修改解析结果）。"""
+    program_text = (ROOT_DIR / dsl_path).read_text(encoding="utf-8")
+    return program_text, parse(program_text)
 
 # ========= 路由 =========
+# 首页模板不依赖任何变量：首次请求时渲染一次并压缩好，之后直接返回（原文, gzip）字节
+_index_cache: Optional[Tuple[bytes, bytes]] = None
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """按 token 与 q 值解析 Accept-Encoding：gzip（没有单独列出时看 *）且 q > 0 才算接受。"""
+    star = False
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        coding = coding.strip().lower()
+        if coding in ("gzip", "x-gzip"):
+            return q > 0
+        if coding == "*":
+            star = q > 0
+    return star
+
 @app.get("/", response_class=HTMLResponse)
-def index():
+def index(request: Request):
+    global _index_cache
     if not TEMPLATES_DIR.exists():
         return HTMLResponse("<h1>⚠ templates 目录不存在</h1>", status_code=500)
-    tpl = env.get_template("index.html")
-    return tpl.render()
+    if _index_cache is None:
+        html = env.get_template("index.html").render().encode("utf-8")
+        _index_cache = (html, gzip.compress(html, 9))
+    html, html_gz = _index_cache
+    if _accepts_gzip(request.headers.get("accept-encoding", "")):
+        return HTMLResponse(html_gz, headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+    return HTMLResponse(html, headers={"Vary": "Accept-Encoding"})
+
+# 请求体：由 FastAPI/pydantic 直接解析并校验 JSON，不再经过 request.json()
+class StartRequest(BaseModel):
+    dsl_path: str = "examples/customer.dsl"
+    use_llm: bool = False
+
+class SendRequest(BaseModel):
+    session_id: Optional[str] = None   # 缺失时与无效会话一样返回 400
+    text: str = ""
 
 @app.post("/api/start")
-async def api_start(request: Request):
-    data = await request.json()
-    dsl_path = data.get("dsl_path", "examples/customer.dsl")
-    use_llm = bool(data.get("use_llm", False))
+async def api_start(body: StartRequest):
+    dsl_path = body.dsl_path
+    use_llm = body.use_llm
 
     path = ROOT_DIR / dsl_path
     if not path.exists():
         raise HTTPException(status_code=404, detail=f"DSL 文件不存在: {dsl_path}")
 
-    program_text = path.read_text(encoding="utf-8")
-    sid = uuid.uuid4().hex
-    SESSIONS[sid] = SessionState(program_text, dsl_path, use_llm)
-    payload = SESSIONS[sid].step(user_text=None)   # 首次推进，欢迎语 + 首个 ask 提示
-    return JSONResponse({"session_id": sid, **payload})
+    # 读文件与解析放到线程池，大脚本首次加载时不阻塞事件循环里的其他请求
+    program_text, program = await asyncio.to_thread(_load_dsl, dsl_path, path.stat().st_mtime_ns)
+    sid = secrets.token_hex(16)   # 32 位十六进制，与 uuid4().hex 同样不可猜测，但不必构造 UUID 对象
+    session = SessionState(program_text, dsl_path, use_llm, program)
+    _add_session(sid, session)
+    payload = await _step(sid, session, None)   # 首次推进，欢迎语 + 首个 ask 提示
+    return ApiResponse({"session_id": sid, **payload})
 
 @app.post("/api/send")
-async def api_send(request: Request):
-    data = await request.json()
-    sid = data.get("session_id")
-    text = data.get("text", "")
+async def api_send(body: SendRequest):
+    sid = body.session_id
+    text = body.text
 
-    if not sid or sid not in SESSIONS:
+    session = _get_session(sid)
+    if session is None:
         raise HTTPException(status_code=400, detail="无效的会话，请先启动会话。")
 
-    payload = SESSIONS[sid].step(user_text=text)
-    return JSONResponse({"session_id": sid, **payload})
+    payload = await _step(sid, session, text)
+    return ApiResponse({"session_id": sid, **payload})